@@ -0,0 +1,101 @@
+'''
+Compares decoding OTX responses the old way (response.text + json.loads)
+against JSONCodec, which decodes straight from the response bytes, for
+each installed backend. Also times encoding the relationship payload sent
+to CRITs for every indicator.
+
+    python3 benchmarks/json_codec.py --pulses 10 --indicators 1000
+'''
+import argparse
+import json
+import os
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from mock_servers import make_corpus
+from otx2crits import JSONCodec, orjson
+
+
+def make_response(body, content_type):
+    response = requests.models.Response()
+    response.status_code = 200
+    response._content = body
+    response.headers['Content-Type'] = content_type
+    return response
+
+
+def best_of(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def report(name, elapsed, baseline):
+    print('{:<34} {:>9.2f} ms {:>6.1f}x'.format(name, elapsed * 1000,
+                                                baseline / elapsed))
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--pulses', dest='pulses', default=10, type=int,
+                           help='Pulses in the page.')
+    argparser.add_argument('--indicators', dest='indicators', default=1000,
+                           type=int, help='Indicators per pulse.')
+    argparser.add_argument('--repeat', dest='repeat', default=5, type=int)
+    args = argparser.parse_args()
+
+    page = {'count': args.pulses, 'next': None, 'previous': None,
+            'results': make_corpus(args.pulses, args.indicators)}
+    body = json.dumps(page).encode('utf-8')
+    print('Page of {} pulses with {} indicators each: {:.1f} MB'.format(
+        args.pulses, args.indicators, len(body) / 1048576.0))
+
+    backends = ['json'] + (['orjson'] if orjson is not None else [])
+    # Without a charset, requests guesses the encoding of .text by looking
+    # at the body
+    for content_type in ('application/json',
+                         'application/json; charset=utf-8'):
+        response = make_response(body, content_type)
+        print('Decoding, Content-Type: {}'.format(content_type))
+
+        def text_loads():
+            response.encoding = None
+            return json.loads(response.text)
+
+        baseline = best_of(text_loads, args.repeat)
+        report('response.text + json.loads', baseline, baseline)
+        for backend in backends:
+            codec = JSONCodec(backend)
+            report('JSONCodec({}).loads(content)'.format(backend),
+                   best_of(lambda: codec.loads(response.content),
+                           args.repeat), baseline)
+
+    payloads = [{
+        'action' : 'forge_relationship',
+        'right_type' : 'Indicator',
+        'right_id' : '{:024x}'.format(n),
+        'rel_type' : 'Related To',
+        'rel_date' : '2016-01-01 00:00:00.000000',
+        'rel_confidence' : 'high',
+        'rel_reason' : 'Related during automatic OTX import',
+    } for n in range(args.pulses * args.indicators)]
+    print('Encoding {} relationship payloads'.format(len(payloads)))
+    baseline = best_of(lambda: [json.dumps(p) for p in payloads], args.repeat)
+    report('json.dumps', baseline, baseline)
+    for backend in backends:
+        codec = JSONCodec(backend)
+        report('JSONCodec({}).dumps'.format(backend),
+               best_of(lambda: [codec.dumps(p) for p in payloads],
+                       args.repeat), baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,426 @@
+'''
+Local stand-ins for the OTX and CRITs APIs that otx2crits talks to, for
+benchmarking without touching the real services. Both servers keep their
+state in memory, count the calls they receive, and can add latency and
+inject errors. GET responses carry an ETag and honour If-None-Match, and
+larger bodies are gzipped for clients that accept it.
+
+    python3 benchmarks/mock_servers.py --pulses 100 --indicators 20
+
+starts both servers in the foreground and prints their URLs.
+'''
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    '''
+    Shared request plumbing: latency, error injection, call counting and
+    JSON responses. Subclasses implement route().
+    '''
+    protocol_version = 'HTTP/1.1'
+    # Small writes on keep-alive connections otherwise stall on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length else b''
+
+
+    def send_json(self, status, obj, headers=None):
+        body = json.dumps(obj).encode('utf-8')
+        headers = dict(headers or {})
+        if self.command == 'GET' and status == 200:
+            # Validators and conditional requests, like a caching server
+            etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+            headers['ETag'] = etag
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.server.count_not_modified()
+                return
+        if 'gzip' in self.headers.get('Accept-Encoding', '') and \
+                len(body) > 1024:
+            body = gzip.compress(body, 5)
+            headers['Content-Encoding'] = 'gzip'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count_bytes(len(body))
+
+
+    def handle_call(self):
+        url = urlparse(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        body = self.read_body() if self.command in ('POST', 'PATCH') else b''
+        self.server.count_call(self.command, url.path)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.error_rate and random.random() < self.server.error_rate:
+            if random.random() < 0.5:
+                return self.send_json(503, {'message': 'Injected throttle'},
+                                      headers={'Retry-After': '1'})
+            return self.send_json(500, {'message': 'Injected error'})
+        self.route(url.path, query, body)
+
+
+    do_GET = handle_call
+    do_POST = handle_call
+    do_PATCH = handle_call
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler, latency=0.0, error_rate=0.0):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.lock = threading.RLock()
+        self.reset_counters()
+
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls = {}
+            self.bytes_sent = 0
+            self.not_modified = 0
+
+
+    def count_call(self, method, path):
+        # Collapse object ids so calls group by endpoint
+        path = re.sub(r'/[0-9a-f]{24}/', '/<id>/', path)
+        with self.lock:
+            key = '{} {}'.format(method, path)
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+
+    def count_not_modified(self):
+        with self.lock:
+            self.not_modified += 1
+
+
+    def count_bytes(self, count):
+        with self.lock:
+            self.bytes_sent += count
+
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+class OTXHandler(MockHandler):
+
+    def route(self, path, query, body):
+        if path == '/api/v1/pulses/subscribed':
+            return self.subscribed(query)
+        match = re.match(r'^/api/v1/pulses/([^/]+)/?$', path)
+        if match:
+            pulse = self.server.pulses_by_id.get(match.group(1))
+            if pulse is None:
+                return self.send_json(404, {'detail': 'Not found.'})
+            return self.send_json(200, pulse)
+        self.send_json(404, {'detail': 'Not found.'})
+
+
+    def subscribed(self, query):
+        limit = int(query.get('limit', 5))
+        page = int(query.get('page', 1))
+        pulses = self.server.pulses
+        if 'modified_since' in query:
+            since = query['modified_since'].replace(' ', 'T')
+            pulses = [p for p in pulses if p['modified'] > since]
+        start = (page - 1) * limit
+        results = pulses[start:start + limit]
+        if 'fields' in query:
+            fields = query['fields'].split(',')
+            results = [{k: p[k] for k in fields if k in p} for p in results]
+        next_url = None
+        if start + limit < len(pulses):
+            args = dict(query)
+            args['page'] = page + 1
+            next_url = '{}/api/v1/pulses/subscribed?{}'.format(
+                self.server.url, urlencode(args))
+        self.send_json(200, {
+            'count' : len(pulses),
+            'next' : next_url,
+            'previous' : None,
+            'results' : results,
+        })
+
+
+class OTXServer(MockServer):
+    '''
+    Serves /pulses/subscribed (newest first, paginated, honouring
+    modified_since and fields) and /pulses/<id> from an in-memory corpus
+    '''
+
+    def __init__(self, pulses, **kwargs):
+        MockServer.__init__(self, OTXHandler, **kwargs)
+        self.set_pulses(pulses)
+
+
+    def set_pulses(self, pulses):
+        self.pulses = sorted(pulses, key=lambda p: p['modified'], reverse=True)
+        self.pulses_by_id = {p['id']: p for p in self.pulses}
+
+
+class CRITsHandler(MockHandler):
+
+    def route(self, path, query, body):
+        if query.get('api_key') is None or query.get('username') is None:
+            return self.send_json(401, {'message': 'Not authorized'})
+        if path == '/api/v1/events/' and self.command == 'GET':
+            return self.list_events(query)
+        if path == '/api/v1/events/' and self.command == 'POST':
+            return self.add_event(parse_qs(body.decode('utf-8')))
+        if path == '/api/v1/indicators/' and self.command == 'POST':
+            return self.add_indicator(parse_qs(body.decode('utf-8')))
+        if path == '/api/v1/indicators/' and self.command == 'PATCH':
+            if not self.server.bulk:
+                return self.send_json(405, {'message': 'Not allowed'})
+            return self.add_indicators(json.loads(body.decode('utf-8')))
+        match = re.match(r'^/api/v1/events/([^/]+)/$', path)
+        if match and self.command == 'PATCH':
+            return self.patch_event(match.group(1), body)
+        self.send_json(404, {'message': 'Not found'})
+
+
+    def create_indicator(self, form):
+        if not form.get('type') or not form.get('value'):
+            return {'return_code': 1, 'message': 'Missing type or value'}
+        key = (form['type'], form['value'])
+        with self.server.lock:
+            indicator_id = self.server.indicators.get(key)
+            if indicator_id is None:
+                indicator_id = self.server.new_id()
+                self.server.indicators[key] = indicator_id
+        return {'return_code': 0, 'id': indicator_id,
+                'message': 'Indicator added'}
+
+
+    def add_indicators(self, data):
+        self.send_json(200, {'objects': [self.create_indicator(form) for
+                                         form in data.get('objects') or []]})
+
+
+    def list_events(self, query):
+        events = self.server.events
+        ticket = query.get('c-tickets.ticket_number')
+        with self.server.lock:
+            if ticket is not None:
+                matches = [e for e in events.values()
+                           if ticket in e['ticket_numbers']]
+            else:
+                matches = list(events.values())
+        offset = int(query.get('offset', 0))
+        limit = int(query.get('limit', 20))
+        objects = [{'_id': e['_id'], 'tickets': e['tickets']}
+                   for e in matches[offset:offset + limit]]
+        self.send_json(200, {
+            'meta' : {'total_count': len(matches), 'limit': limit,
+                      'offset': offset},
+            'objects' : objects,
+        })
+
+
+    def add_event(self, form):
+        if 'title' not in form or 'source' not in form:
+            return self.send_json(200, {'return_code': 1,
+                                        'message': 'Missing title or source'})
+        event_id = self.server.new_id()
+        with self.server.lock:
+            self.server.events[event_id] = {
+                '_id' : event_id,
+                'title' : form['title'][0],
+                'tickets' : [],
+                'ticket_numbers' : set(),
+                'relationships' : [],
+            }
+        self.send_json(200, {'return_code': 0, 'id': event_id,
+                             'message': 'Event added'})
+
+
+    def add_indicator(self, form):
+        self.send_json(200, self.create_indicator(
+            {k: v[0] for k, v in form.items()}))
+
+
+    def patch_event(self, event_id, body):
+        try:
+            data = json.loads(body.decode('utf-8'))
+        except ValueError:
+            data = {k: v[-1] for k, v in
+                    parse_qs(body.decode('utf-8')).items()}
+        with self.server.lock:
+            event = self.server.events.get(event_id)
+            if event is None:
+                return self.send_json(404, {'message': 'No such event'})
+            if 'objects' in data and self.server.bulk:
+                response = {'objects': [self.apply_action(event, action)
+                                        for action in data['objects']]}
+            else:
+                response = self.apply_action(event, data)
+        self.send_json(200, response)
+
+
+    def apply_action(self, event, data):
+        if data.get('action') == 'ticket_add':
+            event['tickets'].append(data['ticket'])
+            event['ticket_numbers'].add(data['ticket']['ticket_number'])
+        elif data.get('action') == 'forge_relationship':
+            if data.get('right_id') in event['relationships']:
+                return {'return_code': 1,
+                        'message': 'Relationship already exists'}
+            event['relationships'].append(data.get('right_id'))
+        else:
+            return {'return_code': 1, 'message': 'Unknown action'}
+        return {'return_code': 0}
+
+
+class CRITsServer(MockServer):
+    '''
+    Serves the CRITs events and indicators API endpoints otx2crits uses,
+    keeping events, tickets, indicators and relationships in memory. With
+    bulk, it also takes batches of indicators and event actions as a PATCH
+    of {"objects": [...]}, which stock CRITs does not.
+    '''
+
+    def __init__(self, bulk=False, **kwargs):
+        MockServer.__init__(self, CRITsHandler, **kwargs)
+        self.bulk = bulk
+        self.events = {}
+        self.indicators = {}
+        self.next_id = 0
+
+
+    def new_id(self):
+        with self.lock:
+            self.next_id += 1
+            return '{:024x}'.format(self.next_id)
+
+
+    def relationship_count(self):
+        with self.lock:
+            return sum(len(e['relationships']) for e in self.events.values())
+
+
+def make_pulse(number, indicators, modified=None):
+    '''
+    Builds a pulse shaped like the ones OTX returns from the given
+    (type, value) indicator pairs
+    '''
+    if modified is None:
+        modified = datetime.datetime(2016, 1, 1) + \
+            datetime.timedelta(minutes=number)
+    timestamp = modified.strftime('%Y-%m-%dT%H:%M:%S.%f')
+    return {
+        'id' : '{:024x}'.format(0x5700000000 + number),
+        'name' : 'Benchmark pulse {}'.format(number),
+        'description' : 'Synthetic pulse {}'.format(number),
+        'author_name' : 'benchmark',
+        'created' : timestamp,
+        'modified' : timestamp,
+        'references' : [],
+        'tags' : ['benchmark'],
+        'tlp' : 'green',
+        'indicators' : [{
+            'id' : number * 1000000 + i,
+            'type' : _type,
+            'indicator' : value,
+            'created' : timestamp,
+            'title' : '',
+            'description' : '',
+            'content' : '',
+        } for i, (_type, value) in enumerate(indicators)],
+    }
+
+
+def make_corpus(pulses, indicators_per_pulse, overlap=0.0, seed=0):
+    '''
+    Builds a list of pulses. With overlap above 0, that share of each
+    pulse's indicators is drawn from a pool shared by every pulse.
+    '''
+    rng = random.Random(seed)
+    shared = ['192.0.2.{}'.format(i % 256) if i < 256 else
+              'shared{}.example.com'.format(i)
+              for i in range(max(1, indicators_per_pulse * 2))]
+    corpus = []
+    for number in range(pulses):
+        indicators = []
+        for i in range(indicators_per_pulse):
+            if rng.random() < overlap:
+                value = rng.choice(shared)
+            else:
+                value = 'p{}i{}.example.com'.format(number, i)
+            _type = 'IPv4' if value.startswith('192.') else 'domain'
+            indicators.append((_type, value))
+        corpus.append(make_pulse(number, indicators))
+    return corpus
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--pulses', dest='pulses', default=100, type=int)
+    argparser.add_argument('--indicators', dest='indicators', default=20,
+                           type=int, help='Indicators per pulse.')
+    argparser.add_argument('--overlap', dest='overlap', default=0.0,
+                           type=float, help='Share of indicators drawn from '
+                           'a pool shared by all pulses.')
+    argparser.add_argument('--latency', dest='latency', default=0.0,
+                           type=float, help='Seconds added to every call.')
+    argparser.add_argument('--error-rate', dest='error_rate', default=0.0,
+                           type=float, help='Share of calls that fail.')
+    argparser.add_argument('--bulk', dest='bulk', action='store_true',
+                           default=False, help='Take batches of indicators '
+                           'and event actions.')
+    args = argparser.parse_args()
+
+    kwargs = {'latency': args.latency, 'error_rate': args.error_rate}
+    otx = OTXServer(make_corpus(args.pulses, args.indicators, args.overlap),
+                    **kwargs).start()
+    crits = CRITsServer(bulk=args.bulk, **kwargs).start()
+    print('OTX:   {}/api/v1'.format(otx.url))
+    print('CRITs: {}/'.format(crits.url))
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
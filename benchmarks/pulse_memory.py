@@ -0,0 +1,69 @@
+'''
+Compares the memory held by decoded pulses kept as the raw OTX dicts against
+the compact Pulse model (Pulse.from_otx), e.g. for the pages waiting in the
+prefetch queue.
+
+    python3 benchmarks/pulse_memory.py --pulses 200 --indicators 500
+'''
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from mock_servers import make_corpus
+from otx2crits import Pulse
+
+
+def load_raw(pages):
+    return [json.loads(page)['results'] for page in pages]
+
+
+def load_pulses(pages):
+    return [[Pulse.from_otx(raw) for raw in json.loads(page)['results']]
+            for page in pages]
+
+
+def measure(name, func, pages):
+    # Timed and traced separately, tracemalloc slows everything down
+    start = time.time()
+    func(pages)
+    elapsed = time.time() - start
+    gc.collect()
+    tracemalloc.start()
+    held = func(pages)
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del held
+    print('{:<8} {:>9.1f} MB held {:>9.1f} MB peak {:>7.2f} s'.format(
+        name, current / 1048576.0, peak / 1048576.0, elapsed))
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--pulses', dest='pulses', default=200, type=int)
+    argparser.add_argument('--indicators', dest='indicators', default=500,
+                           type=int, help='Indicators per pulse.')
+    argparser.add_argument('--page-size', dest='page_size', default=20,
+                           type=int, help='Pulses per page.')
+    args = argparser.parse_args()
+
+    corpus = make_corpus(args.pulses, args.indicators, overlap=0.5)
+    pages = [json.dumps({'results': corpus[n:n + args.page_size]})
+             for n in range(0, len(corpus), args.page_size)]
+    del corpus
+    print('{} pulses, {} indicators, {:.1f} MB of JSON'.format(
+        args.pulses, args.pulses * args.indicators,
+        sum(len(page) for page in pages) / 1048576.0))
+    measure('raw', load_raw, pages)
+    measure('Pulse', load_pulses, pages)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+'''
+Measures otx2crits throughput against the local mock OTX and CRITs servers
+in mock_servers.py. Each scenario imports a synthetic corpus in a fresh
+child process and reports pulses per second, HTTP calls per pulse and the
+child's peak RSS.
+
+    python3 benchmarks/run_benchmark.py
+    python3 benchmarks/run_benchmark.py --scenario few-huge --latency 0.02 \
+        --workers 4 --indicator-workers 16 --set otx.streaming=true
+    python3 benchmarks/run_benchmark.py --bulk --set crits.bulk_size=100
+'''
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_servers import CRITsServer, OTXServer, make_corpus
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.join(HERE, '..')
+
+# name: (pulses, indicators per pulse, share of overlapping indicators)
+SCENARIOS = {
+    'many-small' : (500, 5, 0.0),
+    'few-huge' : (3, 5000, 0.0),
+    'high-overlap' : (200, 50, 0.9),
+}
+
+CONFIG_TEMPLATE = '''[otx]
+otx_api_key = benchmark
+otx_url = {otx_url}/api/v1
+[proxy]
+http =
+https =
+[crits]
+prod_url = {crits_url}/
+dev_url = {crits_url}/
+crits_proxy =
+username = benchmark
+prod_api_key = benchmark
+dev_api_key = benchmark
+verify = false
+source = AlienVault OTX
+[state]
+state_dir = {state_dir}
+'''
+
+
+def write_config(path, otx, crits, state_dir, overrides):
+    '''
+    Writes an otx2crits config pointing at the mock servers. overrides are
+    "section.option=value" strings.
+    '''
+    from configparser import ConfigParser
+    config = ConfigParser()
+    config.read_string(CONFIG_TEMPLATE.format(otx_url=otx.url,
+                                              crits_url=crits.url,
+                                              state_dir=state_dir))
+    for override in overrides:
+        key, value = override.split('=', 1)
+        section, option = key.split('.', 1)
+        if not config.has_section(section):
+            config.add_section(section)
+        config.set(section, option, value)
+    with open(path, 'w') as config_file:
+        config.write(config_file)
+
+
+def run_child(args):
+    '''
+    Runs one import in this process and prints the timing as JSON on the
+    last line of stdout
+    '''
+    sys.path.insert(0, REPO)
+    from otx2crits import OTX2CRITs, PulseResult
+
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            otx2crits = OTX2CRITs(config=args.child, full=True)
+            start = time.time()
+            results = otx2crits.execute(
+                workers=args.workers,
+                indicator_workers=args.indicator_workers)
+            elapsed = time.time() - start
+        finally:
+            sys.stdout = stdout
+    print(json.dumps({
+        'elapsed' : elapsed,
+        'pulses' : len(results),
+        'failed' : sum(1 for r in results if r.status == PulseResult.FAILED),
+    }))
+
+
+def run_scenario(name, args):
+    pulses, indicators, overlap = SCENARIOS[name]
+    pulses = max(1, int(pulses * args.scale))
+    kwargs = {'latency': args.latency, 'error_rate': args.error_rate}
+    otx = OTXServer(make_corpus(pulses, indicators, overlap), **kwargs).start()
+    crits = CRITsServer(bulk=args.bulk, **kwargs).start()
+    workdir = tempfile.mkdtemp(prefix='otx2crits-bench-')
+    try:
+        config_path = os.path.join(workdir, 'otx_config')
+        write_config(config_path, otx, crits, os.path.join(workdir, 'state'),
+                     args.overrides)
+        child = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                  '--child', config_path,
+                                  '--workers', str(args.workers),
+                                  '--indicator-workers',
+                                  str(args.indicator_workers)],
+                                 stdout=subprocess.PIPE)
+        output = child.stdout.read()
+        _, status, usage = os.wait4(child.pid, 0)
+        child.returncode = status
+        if status != 0:
+            print('{}: benchmark run failed'.format(name))
+            return None
+        result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    finally:
+        otx.shutdown()
+        crits.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    # ru_maxrss is in kilobytes on Linux
+    result.update({
+        'scenario' : name,
+        'indicators' : pulses * indicators,
+        'otx_calls' : otx.total_calls(),
+        'crits_calls' : crits.total_calls(),
+        'crits_breakdown' : crits.calls,
+        'peak_rss_mb' : usage.ru_maxrss / 1024.0,
+    })
+    return result
+
+
+def print_result(result):
+    pulses = max(1, result['pulses'])
+    print('{scenario:<13} {pulses:>6} {indicators:>8} {rate:>10.1f} '
+          '{calls:>10.1f} {rss:>9.1f} {failed:>6}'.format(
+              scenario=result['scenario'], pulses=result['pulses'],
+              indicators=result['indicators'],
+              rate=result['pulses'] / max(result['elapsed'], 1e-9),
+              calls=(result['otx_calls'] + result['crits_calls']) /
+              float(pulses),
+              rss=result['peak_rss_mb'], failed=result['failed']))
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--scenario', dest='scenarios', action='append',
+                           choices=sorted(SCENARIOS), help='Scenario to run. '
+                           'May be repeated. Defaults to all of them.')
+    argparser.add_argument('--scale', dest='scale', default=1.0, type=float,
+                           help='Multiplies the number of pulses.')
+    argparser.add_argument('--latency', dest='latency', default=0.0,
+                           type=float, help='Seconds the mock servers add to '
+                           'every call.')
+    argparser.add_argument('--error-rate', dest='error_rate', default=0.0,
+                           type=float, help='Share of calls the mock servers '
+                           'fail with a 500 or 503.')
+    argparser.add_argument('--bulk', dest='bulk', action='store_true',
+                           default=False, help='Let the mock CRITs server '
+                           'take batches, see bulk_size.')
+    argparser.add_argument('--workers', dest='workers', default=1, type=int)
+    argparser.add_argument('--indicator-workers', dest='indicator_workers',
+                           default=1, type=int)
+    argparser.add_argument('--set', dest='overrides', action='append',
+                           default=[], help='Override a config option, '
+                           'e.g. --set otx.streaming=true')
+    argparser.add_argument('--json', dest='json', default=None,
+                           help='Also write the results to this file.')
+    argparser.add_argument('--child', dest='child', default=None,
+                           help=argparse.SUPPRESS)
+    args = argparser.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+
+    print('{:<13} {:>6} {:>8} {:>10} {:>10} {:>9} {:>6}'.format(
+        'scenario', 'pulses', 'inds', 'pulses/s', 'calls/pls', 'rss MB',
+        'failed'))
+    results = []
+    for name in args.scenarios or sorted(SCENARIOS):
+        result = run_scenario(name, args)
+        if result:
+            print_result(result)
+            results.append(result)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+'''
+Compares peak memory of decoding a page of pulses in one go (send_otx_get +
+json.loads) against the streaming StreamedPage parser.
+
+    python3 benchmarks/stream_memory.py --indicators 100000
+'''
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from otx2crits import StreamedPage
+
+
+def build_page(fileobj, indicator_count):
+    '''
+    Writes a synthetic /pulses/subscribed page holding one huge pulse
+    '''
+    indicators = []
+    for i in range(indicator_count):
+        indicators.append({
+            'id' : 1000000 + i,
+            'indicator' : '10.{}.{}.{}'.format(i >> 16 & 255, i >> 8 & 255,
+                                               i & 255),
+            'type' : 'IPv4',
+            'created' : '2016-09-14T15:23:11',
+            'title' : '',
+            'description' : 'Synthetic indicator {}'.format(i),
+            'content' : '',
+        })
+    page = {
+        'count' : 1,
+        'next' : None,
+        'results' : [{
+            'id' : '57d96d0a4da2421b2c1b6b4e',
+            'name' : 'Synthetic pulse',
+            'description' : '',
+            'created' : '2016-09-14T15:23:11.000000',
+            'modified' : '2016-09-14T15:23:11.000000',
+            'references' : [],
+            'tags' : ['benchmark'],
+            'indicators' : indicators,
+        }],
+    }
+    fileobj.write(json.dumps(page).encode('utf-8'))
+    fileobj.seek(0)
+
+
+def load_whole_page(fileobj):
+    # What send_otx_get + json.loads do: the body as text, then the page
+    page = json.loads(fileobj.read().decode('utf-8'))
+    count = 0
+    for pulse in page['results']:
+        for indicator in pulse['indicators']:
+            count += 1
+    return count
+
+
+def load_streamed_page(fileobj):
+    page = StreamedPage(fileobj)
+    count = 0
+    for pulse in page.iter_pulses():
+        for indicator in pulse['indicators']:
+            count += 1
+    return count
+
+
+def measure(name, func, fileobj):
+    # Timed and traced separately, tracemalloc slows everything down
+    fileobj.seek(0)
+    start = time.time()
+    count = func(fileobj)
+    elapsed = time.time() - start
+    fileobj.seek(0)
+    tracemalloc.start()
+    func(fileobj)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print('{:<10} {:>8} indicators {:>9.1f} MB peak {:>7.2f} s'.format(
+        name, count, peak / 1048576.0, elapsed))
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--indicators', dest='indicators', default=100000,
+                           type=int, help='Indicators in the synthetic pulse.')
+    args = argparser.parse_args()
+
+    with tempfile.TemporaryFile() as fileobj:
+        build_page(fileobj, args.indicators)
+        size = os.fstat(fileobj.fileno()).st_size
+        print('Page size: {:.1f} MB'.format(size / 1048576.0))
+        measure('json.loads', load_whole_page, fileobj)
+        measure('streaming', load_streamed_page, fileobj)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,157 +1,3242 @@
 import argparse
+import codecs
+import collections
 import datetime
+import email.utils
+import fcntl
+import hashlib
+import ipaddress
 import json
 import os
+import queue
+import random
+import re
 import requests
+import shutil
+import signal
+import socket
+import sqlite3
 import sys
+import tempfile
+import threading
+import time
+import zlib
 
-from pycrits import pycrits
+from array import array
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from configparser import ConfigParser
 
-# Crits vocabulary
-from vocabulary.indicators import IndicatorTypes as it
+# Crits vocabulary
+from vocabulary.indicators import IndicatorTypes as it
+
+# orjson parses and serializes JSON several times faster than the json
+# module, but otx2crits works without it
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# OTX caps how many pulses it returns per page of /pulses/subscribed
+OTX_MAX_PAGE_SIZE = 50
+
+# How OTX formats the created/modified times of pulses
+OTX_TIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+
+
+def parse_otx_timestamp(value):
+    '''
+    Parses an OTX pulse timestamp, returning None if it can't be parsed
+    '''
+    if not value:
+        return None
+    for time_format in OTX_TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    return None
+
+
+def bounded_map(executor, func, iterable, max_in_flight):
+    '''
+    Submits func(item) to the executor for each item, but never keeps more
+    than max_in_flight calls pending, so a long generator is not drained up
+    front. Yields (item, future) pairs in completion order.
+    '''
+    in_flight = {}
+    for item in iterable:
+        if len(in_flight) >= max_in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield in_flight.pop(future), future
+        in_flight[executor.submit(func, item)] = item
+    while in_flight:
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield in_flight.pop(future), future
+
+
+def chunked(iterable, size):
+    '''
+    Yields lists of up to size consecutive items
+    '''
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def prefetch(iterable, depth):
+    '''
+    Consumes iterable in a background thread, keeping up to depth items ready
+    ahead of the consumer. The queue is bounded, so the producer blocks
+    (backpressure) when the consumer falls behind. Errors raised by the
+    producer are re-raised in the consumer.
+    '''
+    done = object()
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((done, e))
+            return
+        put((done, None))
+
+    producer = threading.Thread(target=produce, name='otx-prefetch')
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error:
+                    raise error
+                return
+            yield item
+    finally:
+        # Unblocks the producer if the consumer stops early
+        stop.set()
+
+
+class JSONCodec(object):
+    '''
+    Decodes OTX and CRITs responses and encodes CRITs payloads, with orjson
+    if it is installed and the json module otherwise. Responses are decoded
+    straight from their bytes, without first building a str of the whole
+    body. Payloads are encoded to compact UTF-8 bytes, with datetimes in the
+    format CRITs expects. Lone surrogates, which orjson and UTF-8 reject but
+    JSON allows as escapes, are handled by falling back to json.
+    '''
+    BACKENDS = ('auto', 'orjson', 'json')
+
+    def __init__(self, backend='auto'):
+        if backend not in self.BACKENDS:
+            raise ValueError('Unknown JSON backend {}'.format(backend))
+        if backend == 'auto':
+            backend = 'orjson' if orjson is not None else 'json'
+        if backend == 'orjson' and orjson is None:
+            raise ValueError('The orjson JSON backend is not installed')
+        self.backend = backend
+
+
+    @staticmethod
+    def default(value):
+        if isinstance(value, datetime.datetime):
+            return value.strftime('%Y-%m-%d %H:%M:%S.%f')
+        raise TypeError('{} is not JSON serializable'.format(
+            type(value).__name__))
+
+
+    def loads(self, data):
+        '''
+        Decodes a JSON document from bytes or str
+        '''
+        if self.backend == 'orjson':
+            try:
+                return orjson.loads(data)
+            except orjson.JSONDecodeError:
+                pass
+        # json detects the encoding of bytes itself
+        return json.loads(data)
+
+
+    def dumps(self, value):
+        '''
+        Encodes value as compact JSON in UTF-8 bytes
+        '''
+        try:
+            if self.backend == 'orjson':
+                return orjson.dumps(value, default=self.default,
+                                    option=orjson.OPT_PASSTHROUGH_DATETIME)
+            return json.dumps(value, default=self.default, ensure_ascii=False,
+                              separators=(',', ':')).encode('utf-8')
+        except (TypeError, UnicodeEncodeError):
+            # Escaped to ASCII, surrogates and all
+            return json.dumps(value, default=self.default,
+                              separators=(',', ':')).encode('ascii')
+
+
+JSON_CODEC = JSONCodec()
+
+
+class JSONStreamReader(object):
+    '''
+    A small pull parser over a JSON document in a seekable binary file. Only
+    the containers we walk through are tracked; each leaf value is decoded on
+    its own with json's raw_decode, so memory is bounded by the largest value
+    we ask for rather than by the whole document. Several readers may share
+    one file as long as they share its lock.
+    '''
+    WHITESPACE = ' \t\n\r'
+    NUMBER_TAIL = ('', '.', 'e', 'E', '+', '-', '0', '1', '2', '3', '4', '5',
+                   '6', '7', '8', '9')
+    # Strings (so brackets inside them are ignored), a lone quote marking a
+    # string cut off by the end of the buffer, and brackets
+    SKIP_TOKENS = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|"|[\[\]{}]')
+
+    def __init__(self, fileobj, offset=0, lock=None, chunk_size=65536):
+        self.file = fileobj
+        self.lock = lock or threading.Lock()
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        # buf holds decoded text starting at byte offset base of the file
+        self.buf = ''
+        self.pos = 0
+        self.base = offset
+        self.file_pos = offset
+        self.eof = False
+
+
+    def _fill(self, size=None):
+        with self.lock:
+            self.file.seek(self.file_pos)
+            data = self.file.read(size or self.chunk_size)
+        self.file_pos += len(data)
+        if not data:
+            self.eof = True
+        text = self.utf8.decode(data, final=self.eof)
+        # Drop what has already been parsed
+        self.base += len(self.buf[:self.pos].encode('utf-8'))
+        self.buf = self.buf[self.pos:] + text
+        self.pos = 0
+        return bool(data)
+
+
+    def peek(self):
+        '''
+        Returns the next non-whitespace character without consuming it, or
+        an empty string at the end of the document
+        '''
+        while True:
+            while self.pos < len(self.buf):
+                if self.buf[self.pos] not in self.WHITESPACE:
+                    return self.buf[self.pos]
+                self.pos += 1
+            if not self._fill():
+                return ''
+
+
+    def tell(self):
+        '''
+        Returns the byte offset of the next value in the file
+        '''
+        self.peek()
+        return self.base + len(self.buf[:self.pos].encode('utf-8'))
+
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError('Expected {!r} at byte {} but found '
+                             '{!r}'.format(char, self.tell(), found))
+        self.pos += 1
+
+
+    def value(self):
+        '''
+        Decodes and returns the next complete JSON value
+        '''
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if self.eof:
+                    raise
+                # Read more, growing with the buffer so big values aren't
+                # re-decoded once per chunk
+                self._fill(max(self.chunk_size, len(self.buf)))
+                continue
+            # A number that runs up to the end of what we've read so far may
+            # continue in the next chunk
+            if (not self.eof and isinstance(obj, (int, float))
+                    and self.buf[end:end + 1] in self.NUMBER_TAIL):
+                self._fill()
+                continue
+            self.pos = end
+            return obj
+
+
+    def iter_object(self):
+        '''
+        Walks an object, yielding each key. The caller must consume the
+        matching value (value, skip, iter_object or iter_array) before
+        asking for the next key.
+        '''
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect('}')
+                return
+
+
+    def iter_array(self):
+        '''
+        Walks an array, yielding once per element. The caller must consume
+        each element before asking for the next one.
+        '''
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect(']')
+                return
+
+
+    def skip(self):
+        '''
+        Consumes the next value without decoding it. Containers are skipped
+        by matching brackets, which is much faster than walking them.
+        '''
+        if self.peek() not in ('{', '['):
+            self.value()
+            return
+        depth = 0
+        while True:
+            for match in self.SKIP_TOKENS.finditer(self.buf, self.pos):
+                token = match.group()
+                if token == '"':
+                    # Unterminated string, read more and rescan it
+                    self.pos = match.start()
+                    break
+                if token in ('{', '['):
+                    depth += 1
+                elif token in ('}', ']'):
+                    depth -= 1
+                    if depth == 0:
+                        self.pos = match.end()
+                        return
+                self.pos = match.end()
+            else:
+                self.pos = len(self.buf)
+            if not self._fill():
+                raise ValueError('Unexpected end of document while skipping '
+                                 'a value')
+
+
+class IndicatorStream(object):
+    '''
+    Lazily iterates the indicators array of a streamed pulse, decoding one
+    indicator at a time from the spooled page
+    '''
+
+    def __init__(self, fileobj, lock, offset):
+        self.file = fileobj
+        self.lock = lock
+        self.offset = offset
+
+
+    def __iter__(self):
+        reader = JSONStreamReader(self.file, offset=self.offset,
+                                  lock=self.lock)
+        for _ in reader.iter_array():
+            raw = reader.value()
+            yield Indicator.from_otx(raw)
+
+
+class StreamedPage(object):
+    '''
+    A page of /pulses/subscribed spooled to a temporary file. Opening the
+    page only scans for the "next" link; pulses are decoded one at a time by
+    iter_pulses, with their indicators left in the file as IndicatorStreams.
+    '''
+
+    def __init__(self, fileobj):
+        self.file = fileobj
+        self.lock = threading.Lock()
+        self.next = None
+        self.results_offset = None
+        reader = JSONStreamReader(self.file, lock=self.lock)
+        seen_next = False
+        for key in reader.iter_object():
+            if key == 'next':
+                self.next = reader.value()
+                seen_next = True
+            elif key == 'results':
+                self.results_offset = reader.tell()
+                if seen_next:
+                    break
+                reader.skip()
+            else:
+                reader.skip()
+            if seen_next and self.results_offset is not None:
+                break
+
+
+    def get(self, key, default=None):
+        if key == 'next':
+            return self.next
+        return default
+
+
+    def iter_pulses(self):
+        if self.results_offset is None:
+            return
+        reader = JSONStreamReader(self.file, offset=self.results_offset,
+                                  lock=self.lock)
+        for _ in reader.iter_array():
+            yield read_streamed_pulse(reader, self.file, self.lock)
+
+
+def read_streamed_pulse(reader, fileobj, lock):
+    '''
+    Decodes the pulse object at the reader's position, leaving its
+    indicators in the file as an IndicatorStream
+    '''
+    pulse = {}
+    indicators = []
+    for key in reader.iter_object():
+        if key == 'indicators' and reader.peek() == '[':
+            indicators = IndicatorStream(fileobj, lock, reader.tell())
+            reader.skip()
+        else:
+            pulse[key] = reader.value()
+    pulse['indicators'] = indicators
+    return pulse
+
+
+class TypeTable(object):
+    '''
+    Interns OTX indicator type names as small ints, so packed indicator
+    lists store a code per indicator instead of a string. It is seeded from
+    the indicator mapping table; types OTX adds later get the next code.
+    '''
+
+    def __init__(self, names=()):
+        self.lock = threading.Lock()
+        self.names = []
+        self.codes = {}
+        for name in names:
+            self.code(name)
+
+
+    def code(self, name):
+        code = self.codes.get(name)
+        if code is None:
+            with self.lock:
+                code = self.codes.get(name)
+                if code is None:
+                    code = len(self.names)
+                    self.names.append(sys.intern(name))
+                    self.codes[self.names[code]] = code
+        return code
+
+
+INDICATOR_TYPES = TypeTable()
+
+
+class Indicator(object):
+    '''
+    The two fields of an OTX indicator that otx2crits uses
+    '''
+    __slots__ = ('type', 'indicator')
+
+    def __init__(self, type, indicator):
+        self.type = type
+        self.indicator = indicator
+
+
+    @classmethod
+    def from_otx(cls, raw):
+        '''
+        Builds an indicator from its OTX dict. A missing type or value is
+        an empty string and anything else that isn't a string is str() of
+        it, so a malformed indicator is dropped on its own later on.
+        '''
+        value = raw.get('indicator')
+        return cls(str(raw.get('type') or ''),
+                   '' if value is None else str(value))
+
+
+class IndicatorList(object):
+    '''
+    The indicators of a pulse packed into arrays: a type code from
+    INDICATOR_TYPES per indicator, and every value in one UTF-8 buffer with
+    an array of offsets. That is a few bytes per indicator on top of the
+    value itself, instead of a dict and its strings. Iterating yields
+    Indicator records. Values that aren't strings are stored as str() of
+    them, and lone surrogates survive the round trip, so a malformed
+    indicator fails on its own when it is imported rather than while its
+    page is decoded.
+    '''
+    __slots__ = ('types', 'offsets', 'values')
+
+    def __init__(self, indicators=()):
+        self.types = array('H')
+        self.offsets = array('I', [0])
+        values = []
+        end = 0
+        for i in indicators:
+            i = Indicator.from_otx(i)
+            self.types.append(INDICATOR_TYPES.code(i.type))
+            value = i.indicator.encode('utf-8', 'surrogatepass')
+            values.append(value)
+            end += len(value)
+            self.offsets.append(end)
+        self.values = b''.join(values)
+
+
+    def __len__(self):
+        return len(self.types)
+
+
+    def __iter__(self):
+        names = INDICATOR_TYPES.names
+        offsets = self.offsets
+        values = self.values
+        for n, code in enumerate(self.types):
+            yield Indicator(names[code],
+                            values[offsets[n]:offsets[n + 1]].decode(
+                                'utf-8', 'surrogatepass'))
+
+
+class Pulse(object):
+    '''
+    The fields of an OTX pulse that otx2crits uses. Pulses are converted
+    from the raw OTX dicts as soon as they are decoded, and the raw dicts
+    are dropped. Indicators are an IndicatorList, or an IndicatorStream for
+    streamed pulses.
+    '''
+    __slots__ = ('id', 'name', 'description', 'created', 'modified',
+                 'references', 'tags', 'indicators')
+    META = ('id', 'name', 'description', 'created', 'modified', 'references',
+            'tags')
+
+    def __init__(self, id, name, description='', created=None, modified=None,
+                 references=(), tags=(), indicators=()):
+        self.id = id
+        self.name = name
+        self.description = description
+        self.created = created
+        self.modified = modified
+        self.references = references
+        self.tags = tags
+        self.indicators = indicators
+
+
+    @classmethod
+    def from_otx(cls, raw):
+        indicators = raw.get('indicators') or []
+        if not isinstance(indicators, IndicatorStream):
+            indicators = IndicatorList(indicators)
+        return cls(raw['id'], raw.get('name') or '',
+                   description=raw.get('description') or '',
+                   created=raw.get('created'),
+                   modified=raw.get('modified'),
+                   references=list(raw.get('references') or []),
+                   # The same few tags turn up on many pulses
+                   tags=[sys.intern(str(tag)) for tag in raw.get('tags') or []
+                         if tag is not None and tag != ''],
+                   indicators=indicators)
+
+
+    def meta(self):
+        '''
+        Returns everything but the indicators, as OTX names it
+        '''
+        return dict((key, getattr(self, key)) for key in self.META)
+
+
+class Metrics(object):
+    '''
+    Per-stage call counts, latency histograms, bytes transferred and error
+    counts for a run. Written out as a JSON run summary and, optionally, in
+    the Prometheus textfile collector format.
+    '''
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+               30.0, 60.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self):
+        '''
+        Clears the stats, so a long-lived process reports each run on its own
+        '''
+        with self.lock:
+            self.started = time.time()
+            self.stages = {}
+
+
+    def _stage(self, stage):
+        if stage not in self.stages:
+            self.stages[stage] = {
+                'count' : 0,
+                'errors' : 0,
+                'seconds' : 0.0,
+                'bytes_in' : 0,
+                'bytes_out' : 0,
+                'buckets' : [0] * len(self.BUCKETS),
+            }
+        return self.stages[stage]
+
+
+    def observe(self, stage, seconds, ok=True, bytes_in=0, bytes_out=0):
+        with self.lock:
+            stats = self._stage(stage)
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['bytes_in'] += bytes_in
+            stats['bytes_out'] += bytes_out
+            if not ok:
+                stats['errors'] += 1
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    stats['buckets'][i] += 1
+                    break
+
+
+    def add_bytes(self, stage, bytes_in=0, bytes_out=0):
+        with self.lock:
+            stats = self._stage(stage)
+            stats['bytes_in'] += bytes_in
+            stats['bytes_out'] += bytes_out
+
+
+    def timer(self, stage):
+        return StageTimer(self, stage)
+
+
+    def summary(self):
+        '''
+        Returns the per-stage stats as a dictionary, buckets included
+        '''
+        with self.lock:
+            stages = {}
+            for stage, stats in self.stages.items():
+                stats = dict(stats)
+                stats['mean_seconds'] = stats['seconds'] / stats['count'] \
+                    if stats['count'] else 0.0
+                # (upper bound, calls) pairs, not cumulative
+                stats['buckets'] = list(zip(self.BUCKETS, stats['buckets']))
+                stages[stage] = stats
+        return stages
+
+
+    @staticmethod
+    def label_value(value):
+        '''
+        Escapes a label value for the Prometheus text format
+        '''
+        return str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n')
+
+
+    def prometheus(self, extra_gauges=(), labels=None):
+        '''
+        Renders the stage stats, plus any (name, labels, value, help)
+        gauges, in the Prometheus text exposition format. labels are added
+        to every stage sample.
+        '''
+        lines = []
+        common = ''.join('{}="{}",'.format(k, self.label_value(v))
+                         for k, v in sorted((labels or {}).items()))
+        with self.lock:
+            stages = [(self.label_value(stage), stats)
+                      for stage, stats in sorted(self.stages.items())]
+            name = 'otx2crits_stage_duration_seconds'
+            lines.append('# HELP {} Time spent per call in each stage of the '
+                         'last run.'.format(name))
+            lines.append('# TYPE {} histogram'.format(name))
+            for stage, stats in stages:
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS, stats['buckets']):
+                    cumulative += count
+                    lines.append('{}_bucket{{{}stage="{}",le="{}"}} '
+                                 '{}'.format(name, common, stage, bound,
+                                             cumulative))
+                lines.append('{}_bucket{{{}stage="{}",le="+Inf"}} {}'.format(
+                    name, common, stage, stats['count']))
+                lines.append('{}_sum{{{}stage="{}"}} {}'.format(
+                    name, common, stage, stats['seconds']))
+                lines.append('{}_count{{{}stage="{}"}} {}'.format(
+                    name, common, stage, stats['count']))
+            for metric, key, description in (
+                    ('otx2crits_stage_errors', 'errors',
+                     'Failed calls in each stage of the last run.'),
+                    ('otx2crits_stage_bytes_received', 'bytes_in',
+                     'Bytes received in each stage of the last run.'),
+                    ('otx2crits_stage_bytes_sent', 'bytes_out',
+                     'Bytes sent in each stage of the last run.')):
+                lines.append('# HELP {} {}'.format(metric, description))
+                lines.append('# TYPE {} gauge'.format(metric))
+                for stage, stats in stages:
+                    lines.append('{}{{{}stage="{}"}} {}'.format(
+                        metric, common, stage, stats[key]))
+        # Samples of one metric have to be listed together
+        families = collections.OrderedDict()
+        for metric, labels, value, description in extra_gauges:
+            families.setdefault((metric, description), []).append((labels,
+                                                                   value))
+        for (metric, description), samples in families.items():
+            lines.append('# HELP {} {}'.format(metric, description))
+            lines.append('# TYPE {} gauge'.format(metric))
+            for labels, value in samples:
+                label_text = ','.join('{}="{}"'.format(k, self.label_value(v))
+                                      for k, v in sorted(labels.items()))
+                if label_text:
+                    lines.append('{}{{{}}} {}'.format(metric, label_text,
+                                                      value))
+                else:
+                    lines.append('{} {}'.format(metric, value))
+        return '\n'.join(lines) + '\n'
+
+
+class StageTimer(object):
+    '''
+    Context manager that records how long a block took as one call to a
+    stage. Call fail() inside the block to count it as an error.
+    '''
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+        self.ok = True
+
+
+    def fail(self):
+        self.ok = False
+
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.stage, time.time() - self.start,
+                             ok=self.ok and exc_type is None)
+        return False
+
+
+def write_atomically(path, text):
+    '''
+    Writes a file via a temporary file and a rename, so readers such as the
+    node_exporter textfile collector never see a half-written file
+    '''
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(dir=directory, prefix='.otx2crits')
+    with os.fdopen(handle, 'w') as temp_file:
+        temp_file.write(text)
+    os.chmod(temp_path, 0o644)
+    os.replace(temp_path, path)
+
+
+class RateControl(object):
+    '''
+    Rate and concurrency control shared by every call to one service (OTX or
+    CRITs). Calls go through a token bucket (rate_limit calls per second, 0
+    for no limit). A 429 or 503 with Retry-After pauses every caller until
+    the server is ready. Throttling, 5xx responses and connection errors are
+    retried with exponential backoff and jitter.
+
+    Concurrency adapts the same way TCP does: each throttle or error halves
+    the number of calls allowed in flight, and every run of successes lets
+    one more through, up to max_concurrency.
+    '''
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+    # Statuses that mean the server did not act on the request, so even
+    # requests that aren't safe to repeat can be retried
+    THROTTLE_STATUS = (429, 503)
+
+    def __init__(self, name, rate_limit=0, max_concurrency=10, max_retries=5,
+                 backoff=1.0, max_backoff=60.0, timeout=60, metrics=None):
+        self.name = name
+        self.metrics = metrics
+        self.rate_limit = rate_limit
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.tokens = float(max(1, rate_limit))
+        self.last_refill = time.time()
+        self.paused_until = 0
+        self.limit = self.max_concurrency
+        self.in_flight = 0
+        self.successes = 0
+        self.retries = 0
+        self.throttled = 0
+
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                now = time.time()
+                wait_for = self.paused_until - now
+                if wait_for <= 0 and self.rate_limit > 0:
+                    self.tokens = min(float(max(1, self.rate_limit)),
+                                      self.tokens + (now - self.last_refill) *
+                                      self.rate_limit)
+                    self.last_refill = now
+                    if self.tokens < 1:
+                        wait_for = (1 - self.tokens) / self.rate_limit
+                if wait_for <= 0 and self.in_flight < self.limit:
+                    if self.rate_limit > 0:
+                        self.tokens -= 1
+                    self.in_flight += 1
+                    return
+                self.condition.wait(wait_for if wait_for > 0 else None)
+
+
+    def release(self, ok):
+        with self.condition:
+            self.in_flight -= 1
+            if ok:
+                self.successes += 1
+                if self.successes >= self.limit and \
+                        self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self.successes = 0
+            self.condition.notify_all()
+
+
+    def slow_down(self, retry_after=None):
+        '''
+        Halves the concurrency limit and, if the server told us how long to
+        wait, pauses every caller until then
+        '''
+        with self.condition:
+            self.throttled += 1
+            self.successes = 0
+            if self.limit > 1:
+                self.limit = max(1, self.limit // 2)
+                print('{} is struggling, allowing {} calls at a '
+                      'time'.format(self.name, self.limit))
+            if retry_after:
+                self.paused_until = max(self.paused_until,
+                                        time.time() + retry_after)
+            self.condition.notify_all()
+
+
+    def get_retry_after(self, response):
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(0, int(value))
+        except ValueError:
+            pass
+        try:
+            when = email.utils.parsedate_to_datetime(value)
+            return max(0, when.timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+    def get_backoff(self, attempt):
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * (2 ** attempt)))
+
+
+    def record(self, stage, start, r, streamed=False):
+        '''
+        Records one attempt of a call in the metrics, if we have any
+        '''
+        if self.metrics is None or stage is None:
+            return
+        bytes_in = bytes_out = 0
+        if r is not None:
+            if r.request is not None and r.request.body:
+                bytes_out = len(r.request.body)
+            # Streamed bodies haven't been read yet, their callers count them
+            if r.headers.get('Content-Length'):
+                bytes_in = int(r.headers['Content-Length'])
+            elif not streamed:
+                bytes_in = len(r.content)
+        self.metrics.observe(stage, time.time() - start,
+                             ok=r is not None and r.status_code < 400,
+                             bytes_in=bytes_in, bytes_out=bytes_out)
+
+
+    def request(self, session, method, url, idempotent=True, stage=None,
+                **kwargs):
+        '''
+        Sends a request through the session, retrying as described above.
+        Each attempt is recorded in the metrics under stage. Returns the last
+        response, or raises the last connection error once the retries are
+        used up.
+        '''
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            self.acquire()
+            ok = False
+            start = time.time()
+            try:
+                r = session.request(method, url, **kwargs)
+                ok = r.status_code not in self.RETRY_STATUS
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                r = None
+                error = e
+            finally:
+                self.release(ok)
+            self.record(stage, start, r,
+                        streamed=kwargs.get('stream', False))
+            if ok:
+                return r
+
+            retryable = idempotent or (r is not None and
+                                       r.status_code in self.THROTTLE_STATUS)
+            if attempt >= self.max_retries or not retryable:
+                if r is None:
+                    raise error
+                return r
+
+            retry_after = None
+            if r is not None:
+                retry_after = self.get_retry_after(r)
+                reason = 'status code {}'.format(r.status_code)
+                r.close()
+            else:
+                reason = repr(error)
+            self.slow_down(retry_after)
+            delay = retry_after if retry_after is not None \
+                else self.get_backoff(attempt)
+            attempt += 1
+            self.retries += 1
+            print('{} call failed with {}, retry {} of {} in {:.1f}s'.format(
+                self.name, reason, attempt, self.max_retries, delay))
+            time.sleep(delay)
+
+
+class PulseResult(object):
+    '''
+    The outcome of importing a single pulse. A DEFERRED pulse is claimed
+    by another worker and may not be finished yet, so like a FAILED one it
+    holds back the sync mark, but it doesn't fail the run.
+    '''
+    IMPORTED = 'imported'
+    UPDATED = 'updated'
+    SKIPPED = 'skipped'
+    DEFERRED = 'deferred'
+    FAILED = 'failed'
+
+    def __init__(self, pulse_id, title, status, message='', failures=None):
+        self.pulse_id = pulse_id
+        self.title = title
+        self.status = status
+        self.message = message
+        # (indicator, reason) pairs for indicators that could not be added
+        # or related
+        self.failures = failures or []
+
+
+class PulseIndex(object):
+    '''
+    Local SQLite index of the pulses that have been imported into a CRITs
+    instance, mapping pulse_id to the CRITs event id and the import time. It
+    lets us skip pulses we've seen before without querying CRITs. For each
+    pulse it also keeps the OTX modified time it was last fully imported at
+    and the indicators that are already related to its event, so a pulse
+    that changes later can be updated with just its new indicators. Pulses
+    whose indicators were never recorded, because they were imported before
+    this was tracked or were found by a rebuild, have the UNTRACKED modified
+    time.
+
+    The journal tables are a write-ahead log of the pulse being imported:
+    its event id, whether its ticket was added, and each indicator id and
+    relationship as soon as CRITs returns them. A pulse's entries are
+    removed once it is finished, so whatever is left after a crash tells
+    how far each unfinished pulse got.
+    '''
+    UNTRACKED = ''
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # The journal commits after every CRITs call. With write-ahead
+        # logging those commits survive a crash of the process without
+        # waiting for the disk each time.
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS pulses ('
+                        'pulse_id TEXT PRIMARY KEY, '
+                        'event_id TEXT, '
+                        'imported_at TEXT, '
+                        'modified TEXT)')
+        # Indexes created before pulses had a modified time
+        columns = [row[1] for row in
+                   self.db.execute('PRAGMA table_info(pulses)')]
+        if 'modified' not in columns:
+            self.db.execute('ALTER TABLE pulses ADD COLUMN modified TEXT')
+            self.db.execute('UPDATE pulses SET modified = ?',
+                            (self.UNTRACKED,))
+        self.db.execute('CREATE TABLE IF NOT EXISTS pulse_indicators ('
+                        'pulse_id TEXT, '
+                        'indicator_type TEXT, '
+                        'value TEXT, '
+                        'PRIMARY KEY (pulse_id, indicator_type, value))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS indicators ('
+                        'indicator_type TEXT, '
+                        'value TEXT, '
+                        'indicator_id TEXT, '
+                        'used REAL DEFAULT 0, '
+                        'PRIMARY KEY (indicator_type, value))')
+        # Saved indicator caches from before they were merged
+        columns = [row[1] for row in
+                   self.db.execute('PRAGMA table_info(indicators)')]
+        if 'used' not in columns:
+            self.db.execute('ALTER TABLE indicators ADD COLUMN used REAL '
+                            'DEFAULT 0')
+        self.db.execute('CREATE TABLE IF NOT EXISTS journal ('
+                        'pulse_id TEXT PRIMARY KEY, '
+                        'event_id TEXT, '
+                        'ticket INTEGER DEFAULT 0, '
+                        'started TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS journal_indicators ('
+                        'pulse_id TEXT, '
+                        'indicator_type TEXT, '
+                        'value TEXT, '
+                        'indicator_id TEXT, '
+                        'related INTEGER DEFAULT 0, '
+                        'PRIMARY KEY (pulse_id, indicator_type, value))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta ('
+                        'key TEXT PRIMARY KEY, '
+                        'value TEXT)')
+        self.db.commit()
+
+
+    def __contains__(self, pulse_id):
+        with self.lock:
+            row = self.db.execute('SELECT 1 FROM pulses WHERE pulse_id = ?',
+                                  (pulse_id,)).fetchone()
+        return row is not None
+
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM pulses').fetchone()[0]
+
+
+    def get_event_id(self, pulse_id):
+        with self.lock:
+            row = self.db.execute('SELECT event_id FROM pulses WHERE '
+                                  'pulse_id = ?', (pulse_id,)).fetchone()
+        if row:
+            return row[0]
+        return None
+
+
+    def add(self, pulse_id, event_id, imported_at=None):
+        if not imported_at:
+            imported_at = datetime.datetime.now().isoformat()
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO pulses (pulse_id, '
+                            'event_id, imported_at) VALUES (?, ?, ?)',
+                            (pulse_id, event_id, imported_at))
+            self.db.commit()
+
+
+    def get_modified(self, pulse_id):
+        with self.lock:
+            row = self.db.execute('SELECT modified FROM pulses WHERE '
+                                  'pulse_id = ?', (pulse_id,)).fetchone()
+        if row:
+            return row[0]
+        return None
+
+
+    def set_modified(self, pulse_id, modified):
+        with self.lock:
+            self.db.execute('UPDATE pulses SET modified = ? WHERE '
+                            'pulse_id = ?', (modified, pulse_id))
+            self.db.commit()
+
+
+    def get_pulse_indicators(self, pulse_id):
+        '''
+        Returns the set of (OTX type, value) pairs already imported for a
+        pulse
+        '''
+        with self.lock:
+            rows = self.db.execute('SELECT indicator_type, value FROM '
+                                   'pulse_indicators WHERE pulse_id = ?',
+                                   (pulse_id,)).fetchall()
+        return set(rows)
+
+
+    def add_pulse_indicators(self, pulse_id, indicators):
+        '''
+        Records (OTX type, value) pairs as imported for a pulse, in a single
+        transaction
+        '''
+        with self.lock:
+            with self.db:
+                self.db.executemany('INSERT OR IGNORE INTO pulse_indicators '
+                                    '(pulse_id, indicator_type, value) '
+                                    'VALUES (?, ?, ?)',
+                                    ((pulse_id, t, v) for t, v in indicators))
+
+
+    def rebuild(self, rows):
+        '''
+        Brings the index in line with the given (pulse_id, event_id,
+        imported_at) rows in a single transaction. Pulses that are still
+        there keep their modified time and indicators, new ones are
+        UNTRACKED, and pulses missing from rows are removed. A pulse whose
+        event changed is UNTRACKED too, with its recorded indicators, which
+        belonged to the old event, dropped.
+        '''
+        with self.lock:
+            with self.db:
+                self.db.execute('CREATE TEMP TABLE IF NOT EXISTS rebuilt ('
+                                'pulse_id TEXT PRIMARY KEY, '
+                                'event_id TEXT, '
+                                'imported_at TEXT)')
+                self.db.execute('DELETE FROM rebuilt')
+                self.db.executemany('INSERT OR REPLACE INTO rebuilt (pulse_id, '
+                                    'event_id, imported_at) VALUES (?, ?, ?)',
+                                    rows)
+                self.db.execute('DELETE FROM pulse_indicators WHERE pulse_id '
+                                'NOT IN (SELECT pulse_id FROM rebuilt)')
+                self.db.execute('DELETE FROM pulses WHERE pulse_id NOT IN '
+                                '(SELECT pulse_id FROM rebuilt)')
+                # What was recorded for a pulse that moved was for its old
+                # event
+                moved = ('SELECT pulse_id FROM pulses JOIN rebuilt USING '
+                         '(pulse_id) WHERE pulses.event_id IS NOT '
+                         'rebuilt.event_id')
+                self.db.execute('DELETE FROM pulse_indicators WHERE pulse_id '
+                                'IN ({})'.format(moved))
+                self.db.execute('UPDATE pulses SET modified = ? WHERE '
+                                'pulse_id IN ({})'.format(moved),
+                                (self.UNTRACKED,))
+                self.db.execute('UPDATE pulses SET event_id = (SELECT '
+                                'event_id FROM rebuilt WHERE rebuilt.pulse_id '
+                                '= pulses.pulse_id)')
+                self.db.execute('INSERT OR IGNORE INTO pulses (pulse_id, '
+                                'event_id, imported_at, modified) SELECT '
+                                'pulse_id, event_id, imported_at, ? FROM '
+                                'rebuilt', (self.UNTRACKED,))
+                self.db.execute('DELETE FROM rebuilt')
+
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT value FROM meta WHERE key = ?',
+                                  (key,)).fetchone()
+        if row:
+            return row[0]
+        return None
+
+
+    def set_meta(self, key, value):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO meta (key, value) '
+                            'VALUES (?, ?)', (key, value))
+            self.db.commit()
+
+
+    def load_indicators(self, limit=-1):
+        '''
+        Returns the limit most recently used saved (indicator_type, value,
+        indicator_id) rows, least recently used first
+        '''
+        with self.lock:
+            return self.db.execute('SELECT indicator_type, value, indicator_id '
+                                   'FROM (SELECT * FROM indicators ORDER BY '
+                                   'used DESC LIMIT ?) ORDER BY used',
+                                   (limit,)).fetchall()
+
+
+    def save_indicators(self, rows, limit):
+        '''
+        Merges (indicator_type, value, indicator_id, used) rows into the
+        saved indicator ids, then keeps only the limit most recently used.
+        Other processes sharing the state database keep what they saved.
+        '''
+        with self.lock:
+            with self.db:
+                self.db.executemany('INSERT INTO indicators (indicator_type, '
+                                    'value, indicator_id, used) VALUES '
+                                    '(?, ?, ?, ?) ON CONFLICT (indicator_type, '
+                                    'value) DO UPDATE SET indicator_id = '
+                                    'excluded.indicator_id, used = '
+                                    'MAX(used, excluded.used)', rows)
+                self.db.execute('DELETE FROM indicators WHERE rowid IN '
+                                '(SELECT rowid FROM indicators ORDER BY used '
+                                'DESC LIMIT -1 OFFSET ?)', (limit,))
+
+
+    def begin_journal(self, pulse_id, event_id=None, ticket=False):
+        '''
+        Starts the journal of a pulse, replacing anything left of an earlier
+        attempt
+        '''
+        with self.lock:
+            with self.db:
+                self.db.execute('DELETE FROM journal_indicators WHERE '
+                                'pulse_id = ?', (pulse_id,))
+                self.db.execute('INSERT OR REPLACE INTO journal (pulse_id, '
+                                'event_id, ticket, started) VALUES '
+                                '(?, ?, ?, ?)',
+                                (pulse_id, event_id, int(ticket),
+                                 datetime.datetime.now().isoformat()))
+
+
+    def journal_event(self, pulse_id, event_id):
+        with self.lock:
+            self.db.execute('UPDATE journal SET event_id = ? WHERE '
+                            'pulse_id = ?', (event_id, pulse_id))
+            self.db.commit()
+
+
+    def journal_ticket(self, pulse_id):
+        with self.lock:
+            self.db.execute('UPDATE journal SET ticket = 1 WHERE '
+                            'pulse_id = ?', (pulse_id,))
+            self.db.commit()
+
+
+    def journal_indicators(self, pulse_id, indicators):
+        '''
+        Records ((OTX type, value), CRITs id) pairs for a pulse, in a single
+        transaction
+        '''
+        with self.lock:
+            with self.db:
+                self.db.executemany('INSERT OR IGNORE INTO journal_indicators '
+                                    '(pulse_id, indicator_type, value, '
+                                    'indicator_id) VALUES (?, ?, ?, ?)',
+                                    ((pulse_id, t, v, i)
+                                     for (t, v), i in indicators))
+
+
+    def journal_relationship(self, pulse_id, indicator_id):
+        with self.lock:
+            self.db.execute('UPDATE journal_indicators SET related = 1 WHERE '
+                            'pulse_id = ? AND indicator_id = ?',
+                            (pulse_id, indicator_id))
+            self.db.commit()
+
+
+    def get_journal(self, pulse_id):
+        '''
+        Returns how far an unfinished pulse got, as a dict with its event_id
+        (None if the event was never recorded), whether its ticket was
+        added, the CRITs ids of its (OTX type, value) indicators and the set
+        of indicator ids already related. Returns None if the pulse has no
+        journal.
+        '''
+        with self.lock:
+            row = self.db.execute('SELECT event_id, ticket FROM journal '
+                                  'WHERE pulse_id = ?',
+                                  (pulse_id,)).fetchone()
+            if row is None:
+                return None
+            rows = self.db.execute('SELECT indicator_type, value, '
+                                   'indicator_id, related FROM '
+                                   'journal_indicators WHERE pulse_id = ?',
+                                   (pulse_id,)).fetchall()
+        return {
+            'event_id' : row[0],
+            'ticket' : bool(row[1]),
+            'indicators' : dict(((t, v), i) for t, v, i, _ in rows),
+            'related' : set(i for _, _, i, related in rows if related),
+        }
+
+
+    def unfinished_journals(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM '
+                                   'journal').fetchone()[0]
+
+
+    def finish_journal(self, pulse_id):
+        with self.lock:
+            with self.db:
+                self.db.execute('DELETE FROM journal_indicators WHERE '
+                                'pulse_id = ?', (pulse_id,))
+                self.db.execute('DELETE FROM journal WHERE pulse_id = ?',
+                                (pulse_id,))
+
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class SyncCheckpoint(object):
+    '''
+    Keeps the high-water mark of the OTX "modified" times we have fully
+    processed, to use as modified_since on the next run.
+
+    OTX lists subscribed pulses newest first, so while a walk is underway
+    older pulses may still be coming and the mark can't safely move. Each
+    pulse that commits raises the pending mark. The stored mark only moves
+    to it once the walk has reached the end with no failed pulses. A
+    crashed or failed run therefore starts again from the old mark. The
+    pulses it already committed are found in the local index and cost no
+    CRITs calls.
+    '''
+    KEY = 'sync_mark'
+
+    def __init__(self, index, key=KEY):
+        self.index = index
+        self.key = key
+        self.lock = threading.Lock()
+        self.mark = parse_otx_timestamp(index.get_meta(key))
+        self.pending = None
+        self.failed = 0
+        self.deferred = 0
+
+
+    def commit(self, pulse):
+        modified = parse_otx_timestamp(pulse.modified)
+        with self.lock:
+            if modified and (self.pending is None or modified > self.pending):
+                self.pending = modified
+
+
+    def fail(self, pulse):
+        with self.lock:
+            self.failed += 1
+
+
+    def defer(self, pulse):
+        with self.lock:
+            self.deferred += 1
+
+
+    def finish(self, walk_complete, modified_since):
+        '''
+        Moves the mark up to the newest committed pulse, as long as the walk
+        covered everything since the current mark. Returns the new mark.
+        '''
+        if not walk_complete:
+            print('Not every page of pulses was read, keeping the sync mark')
+        elif self.failed:
+            print('{} pulses failed, keeping the sync mark'.format(self.failed))
+        elif self.deferred:
+            print('{} pulses are claimed by other workers, keeping the sync '
+                  'mark'.format(self.deferred))
+        elif self.mark and modified_since and modified_since > self.mark:
+            print('This run started after the sync mark, keeping it')
+        elif self.pending and (self.mark is None or self.pending > self.mark):
+            self.mark = self.pending
+            self.index.set_meta(self.key,
+                                self.mark.strftime(OTX_TIME_FORMATS[0]))
+            print('Sync mark moved to {}'.format(self.mark))
+        # The next walk starts from the mark again
+        with self.lock:
+            self.pending = None
+            self.failed = 0
+            self.deferred = 0
+        return self.mark
+
+
+class IndicatorCache(object):
+    '''
+    LRU cache of (indicator type, value) -> CRITs indicator id. The same
+    indicators turn up in many pulses, and a hit saves an add_indicator call.
+    The time each entry was last used in this run is kept for saving, so
+    only those entries are merged into the state database.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.used = {}
+        self.hits = 0
+        self.misses = 0
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def get(self, indicator_type, value):
+        key = (indicator_type, value)
+        with self.lock:
+            indicator_id = self.entries.get(key)
+            if indicator_id is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.used[key] = time.time()
+            self.hits += 1
+            return indicator_id
+
+
+    def put(self, indicator_type, value, indicator_id, used=True):
+        key = (indicator_type, value)
+        with self.lock:
+            self.entries[key] = indicator_id
+            self.entries.move_to_end(key)
+            if used:
+                self.used[key] = time.time()
+            while len(self.entries) > self.size:
+                key, _ = self.entries.popitem(last=False)
+                self.used.pop(key, None)
+
+
+    def load(self, index):
+        for indicator_type, value, indicator_id in \
+                index.load_indicators(self.size):
+            self.put(indicator_type, value, indicator_id, used=False)
+
+
+    def save(self, index):
+        with self.lock:
+            rows = [(t, v, self.entries[(t, v)], used)
+                    for (t, v), used in self.used.items()]
+            self.used.clear()
+        index.save_indicators(rows, self.size)
+
+
+    def stats(self):
+        return 'Indicator cache: {} hits, {} misses, {} entries'.format(
+            self.hits, self.misses, len(self.entries))
+
+
+class HTTPCache(object):
+    '''
+    On-disk cache of OTX responses that carry an ETag or Last-Modified
+    validator. A cached url is requested again with If-None-Match and
+    If-Modified-Since, and a 304 answer is served from the cached body, so an
+    unchanged page costs only headers. Bodies are kept as files in the cache
+    directory and indexed in a SQLite database. The least recently used
+    bodies are evicted once they add up to more than max_size bytes. Keys
+    include a namespace, e.g. the API key, since OTX answers depend on who
+    asks.
+    '''
+
+    def __init__(self, directory, max_size, namespace=''):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_size = max_size
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(directory, 'index.db'),
+                                  timeout=60, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses ('
+                        'key TEXT PRIMARY KEY, '
+                        'etag TEXT, '
+                        'last_modified TEXT, '
+                        'size INTEGER, '
+                        'used REAL)')
+        self.db.commit()
+        # Bodies left behind by a crash in the middle of a download
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith('.part') and \
+                    os.path.getmtime(path) < time.time() - 3600:
+                os.unlink(path)
+        self.hits = 0
+        self.misses = 0
+
+
+    def key(self, url):
+        return hashlib.sha1('{}\n{}'.format(self.namespace, url)
+                            .encode('utf-8')).hexdigest()
+
+
+    def body_path(self, key):
+        return os.path.join(self.directory, '{}.body'.format(key))
+
+
+    def validators(self, url):
+        '''
+        Returns the conditional request headers for a cached url, or an empty
+        dict if it isn't cached
+        '''
+        with self.lock:
+            row = self.db.execute('SELECT etag, last_modified FROM responses '
+                                  'WHERE key = ?', (self.key(url),)).fetchone()
+        headers = {}
+        if row:
+            if row[0]:
+                headers['If-None-Match'] = row[0]
+            if row[1]:
+                headers['If-Modified-Since'] = row[1]
+        return headers
+
+
+    def open(self, url):
+        '''
+        Opens the cached body of a url that OTX says hasn't changed. Returns
+        None if the body has been evicted since the validators were read.
+        '''
+        key = self.key(url)
+        try:
+            body = open(self.body_path(key), 'rb')
+        except (IOError, OSError):
+            self.discard(key)
+            return None
+        with self.lock:
+            self.db.execute('UPDATE responses SET used = ? WHERE key = ?',
+                            (time.time(), key))
+            self.db.commit()
+            self.hits += 1
+        return body
+
+
+    def new_body(self):
+        '''
+        Returns a temporary file in the cache directory to write a response
+        body to, for commit
+        '''
+        return tempfile.NamedTemporaryFile(dir=self.directory, suffix='.part',
+                                           delete=False)
+
+
+    def commit(self, url, headers, body):
+        '''
+        Stores a body written to a file from new_body under url, if the
+        response has validators. The file stays open, and is rewound for the
+        caller to read.
+        '''
+        body.flush()
+        size = body.tell()
+        body.seek(0)
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        with self.lock:
+            self.misses += 1
+        if not etag and not last_modified:
+            os.unlink(body.name)
+            return body
+        key = self.key(url)
+        os.replace(body.name, self.body_path(key))
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO responses (key, etag, '
+                            'last_modified, size, used) VALUES '
+                            '(?, ?, ?, ?, ?)', (key, etag, last_modified, size,
+                                                time.time()))
+            self.db.commit()
+        self.evict()
+        return body
+
+
+    def store(self, url, headers, content):
+        with self.new_body() as body:
+            body.write(content)
+            self.commit(url, headers, body)
+
+
+    def discard(self, key):
+        with self.lock:
+            self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self.db.commit()
+        try:
+            os.unlink(self.body_path(key))
+        except OSError:
+            pass
+
+
+    def evict(self):
+        '''
+        Drops the least recently used bodies until the rest fit in max_size
+        '''
+        with self.lock:
+            total = self.db.execute('SELECT TOTAL(size) FROM '
+                                    'responses').fetchone()[0]
+            if total <= self.max_size:
+                return
+            victims = []
+            for key, size in self.db.execute('SELECT key, size FROM '
+                                             'responses ORDER BY used'):
+                if total <= self.max_size:
+                    break
+                victims.append(key)
+                total -= size
+        for key in victims:
+            self.discard(key)
+
+
+    def stats(self):
+        return 'OTX response cache: {} pages unchanged, {} downloaded'.format(
+            self.hits, self.misses)
+
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class LeaseStore(object):
+    '''
+    Claims on pulses, shared by every otx2crits worker importing into the
+    same CRITs target through one SQLite database. Workers on several hosts
+    need the database on a shared filesystem. A worker claims a pulse before
+    importing it, so each pulse is imported by exactly one worker. Claims
+    are renewed in the background while the worker is alive and expire
+    after ttl seconds if it dies, so another worker can take the pulse over.
+    Finished pulses stay marked as done so other workers skip them without
+    asking CRITs.
+
+    The journal of each worker is local, so a claim also records the
+    pulse's CRITs event and whether its ticket was added. A worker that
+    takes over a pulse left unfinished, maybe on another host, resumes it
+    with that event instead of skipping it because its ticket exists.
+    '''
+    CLAIMED = 'claimed'
+    BUSY = 'busy'
+    DONE = 'done'
+
+    def __init__(self, path, target, ttl=300):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.target = target
+        self.ttl = ttl
+        self.owner = '{}:{}:{:08x}'.format(socket.gethostname(), os.getpid(),
+                                           random.getrandbits(32))
+        self.lock = threading.Lock()
+        # Transactions are managed by hand so a claim can take the write
+        # lock before it reads
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute('CREATE TABLE IF NOT EXISTS leases ('
+                        'target TEXT, '
+                        'pulse_id TEXT, '
+                        'owner TEXT, '
+                        'expires REAL, '
+                        'done INTEGER DEFAULT 0, '
+                        'event_id TEXT, '
+                        'ticket INTEGER DEFAULT 0, '
+                        'PRIMARY KEY (target, pulse_id))')
+        # Lease databases created before claims recorded their event
+        columns = [row[1] for row in
+                   self.db.execute('PRAGMA table_info(leases)')]
+        if 'event_id' not in columns:
+            self.db.execute('ALTER TABLE leases ADD COLUMN event_id TEXT')
+            self.db.execute('ALTER TABLE leases ADD COLUMN ticket INTEGER '
+                            'DEFAULT 0')
+        self.stopping = threading.Event()
+        self.renewer = threading.Thread(target=self.keep_renewing,
+                                        name='lease-renewer')
+        self.renewer.daemon = True
+        self.renewer.start()
+
+
+    def claim(self, pulse_id, redo=False):
+        '''
+        Tries to claim a pulse. Returns CLAIMED, BUSY if another live worker
+        holds it, or DONE if it has already been imported. With redo, a
+        pulse that is done can be claimed again, e.g. to update it. Taking
+        over an unfinished pulse keeps what its last claim recorded, see
+        get_pending.
+        '''
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.db.execute('SELECT owner, expires, done FROM '
+                                      'leases WHERE target = ? AND '
+                                      'pulse_id = ?',
+                                      (self.target, pulse_id)).fetchone()
+                if row and row[2] and not redo:
+                    status = self.DONE
+                elif row and row[0] != self.owner and row[1] > now and \
+                        self.is_alive(row[0]):
+                    status = self.BUSY
+                else:
+                    self.db.execute('INSERT OR IGNORE INTO leases (target, '
+                                    'pulse_id) VALUES (?, ?)',
+                                    (self.target, pulse_id))
+                    self.db.execute('UPDATE leases SET owner = ?, '
+                                    'expires = ?, done = 0, '
+                                    'event_id = CASE WHEN done THEN NULL '
+                                    'ELSE event_id END, '
+                                    'ticket = CASE WHEN done THEN 0 '
+                                    'ELSE ticket END '
+                                    'WHERE target = ? AND pulse_id = ?',
+                                    (self.owner, now + self.ttl, self.target,
+                                     pulse_id))
+                    status = self.CLAIMED
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+        return status
+
+
+    @staticmethod
+    def is_alive(owner):
+        '''
+        Whether the worker holding a claim may still be running. Only
+        workers on this host can be checked, e.g. one that was killed and
+        restarted before its claims expired.
+        '''
+        host, _, rest = owner.rpartition(':')[0].rpartition(':')
+        if host != socket.gethostname():
+            return True
+        try:
+            os.kill(int(rest), 0)
+        except ProcessLookupError:
+            return False
+        except (OSError, ValueError):
+            pass
+        return True
+
+
+    def get_pending(self, pulse_id):
+        '''
+        Returns how far an unfinished pulse got under its earlier claims, in
+        the form of PulseIndex.get_journal with no indicators done, or None
+        if no event was recorded for it
+        '''
+        with self.lock:
+            row = self.db.execute('SELECT event_id, ticket FROM leases WHERE '
+                                  'target = ? AND pulse_id = ? AND done = 0',
+                                  (self.target, pulse_id)).fetchone()
+        if not row or not row[0]:
+            return None
+        return {
+            'event_id' : row[0],
+            'ticket' : bool(row[1]),
+            'indicators' : {},
+            'related' : set(),
+        }
+
+
+    def journal_event(self, pulse_id, event_id):
+        with self.lock:
+            self.db.execute('UPDATE leases SET event_id = ? WHERE target = ? '
+                            'AND pulse_id = ? AND owner = ?',
+                            (event_id, self.target, pulse_id, self.owner))
+
+
+    def journal_ticket(self, pulse_id):
+        with self.lock:
+            self.db.execute('UPDATE leases SET ticket = 1 WHERE target = ? '
+                            'AND pulse_id = ? AND owner = ?',
+                            (self.target, pulse_id, self.owner))
+
+
+    def release(self, pulse_id, done):
+        '''
+        Gives up a claim, marking the pulse done if it was imported. A pulse
+        that wasn't stays unfinished, with its event, for the next claim.
+        '''
+        with self.lock:
+            self.db.execute('UPDATE leases SET done = ?, expires = ? '
+                            'WHERE target = ? AND pulse_id = ? AND '
+                            'owner = ?', (int(bool(done)), time.time(),
+                                          self.target, pulse_id, self.owner))
+
+
+    def renew(self):
+        '''
+        Extends every claim this worker holds
+        '''
+        with self.lock:
+            self.db.execute('UPDATE leases SET expires = ? WHERE target = ? '
+                            'AND owner = ? AND done = 0',
+                            (time.time() + self.ttl, self.target, self.owner))
+
+
+    def keep_renewing(self):
+        while not self.stopping.wait(self.ttl / 3.0):
+            try:
+                self.renew()
+            except sqlite3.Error as e:
+                print('Error renewing pulse claims: {}'.format(e))
+
+
+    def close(self):
+        self.stopping.set()
+        self.renewer.join()
+        with self.lock:
+            self.db.close()
+
+
+def shard_of(pulse_id, count):
+    '''
+    Maps a pulse id to one of count shards. The hash is stable across
+    processes and hosts, unlike hash().
+    '''
+    digest = hashlib.sha1(pulse_id.encode('utf-8')).hexdigest()
+    return int(digest[:15], 16) % count
+
+
+class IndicatorNormalizer(object):
+    '''
+    Canonicalizes and validates indicator values before they are sent to
+    CRITs, so case variants and trailing dots of the same indicator become
+    one, and values CRITs would reject never cost a round trip. Duplicates
+    within a pulse are dropped. The checks are keyed on the CRITs indicator
+    type each OTX type maps to; types without a check only have surrounding
+    whitespace removed.
+    '''
+    HASH_LENGTHS = {
+        it.MD5: 32,
+        it.SHA1: 40,
+        it.SHA256: 64,
+        it.IMPHASH: 32,
+    }
+    HEX = re.compile(r'^[0-9a-f]+$')
+    DOMAIN = re.compile(r'^(?=.{1,253}$)(?:[a-z0-9_](?:[a-z0-9_-]{0,61}'
+                        r'[a-z0-9_])?\.)+[a-z0-9-]{2,63}$')
+    EMAIL = re.compile(r'^[^@\s]+@([^@\s]+)$')
+    # Scheme and host of a URL without credentials, which are not case
+    # sensitive
+    URL_HOST = re.compile(r'^([A-Za-z][A-Za-z0-9+.-]*://)([^/?#@]*)'
+                          r'([/?#].*)?$', re.DOTALL)
+
+    def __init__(self, mapping):
+        self.mapping = mapping
+        checks = {
+            it.DOMAIN: self.domain,
+            it.IPV4_ADDRESS: self.ipv4,
+            it.IPV6_ADDRESS: self.ipv6,
+            it.IPV4_SUBNET: self.ipv4_subnet,
+            it.EMAIL_ADDRESS: self.email,
+            it.URI: self.uri,
+        }
+        for crits_type in self.HASH_LENGTHS:
+            checks[crits_type] = self.hash
+        # OTX type -> check, resolved once rather than per indicator
+        self.checks = {}
+        for otx_type, crits_type in mapping.items():
+            if crits_type is not None:
+                self.checks[otx_type] = (crits_type,
+                                         checks.get(crits_type, self.plain))
+
+
+    def normalize(self, indicators, stats):
+        '''
+        Yields the indicators of one pulse with canonical values, dropping
+        invalid ones and duplicates. Indicators of types we don't import are
+        passed through untouched. Counts of what was changed or dropped are
+        added to the stats dictionary as the indicators are consumed.
+        '''
+        seen = set()
+        for i in indicators:
+            check = self.checks.get(i.type)
+            if check is None:
+                yield i
+                continue
+            crits_type, canonicalize = check
+            value = i.indicator
+            try:
+                canonical = canonicalize(crits_type, value)
+            except (ValueError, UnicodeError, TypeError, AttributeError):
+                # Not a string, or not a valid one
+                canonical = None
+            if not canonical:
+                print('Dropping invalid {} indicator {!r}'.format(i.type,
+                                                                 value))
+                stats['invalid'] = stats.get('invalid', 0) + 1
+                continue
+            key = (crits_type, canonical)
+            if key in seen:
+                stats['duplicate'] = stats.get('duplicate', 0) + 1
+                continue
+            seen.add(key)
+            if canonical != value:
+                stats['normalized'] = stats.get('normalized', 0) + 1
+                i = Indicator(i.type, canonical)
+            yield i
+
+
+    def plain(self, crits_type, value):
+        return value.strip()
+
+
+    def hash(self, crits_type, value):
+        value = value.strip().lower()
+        if len(value) == self.HASH_LENGTHS[crits_type] and \
+                self.HEX.match(value):
+            return value
+        return None
+
+
+    def domain(self, crits_type, value):
+        value = value.strip().rstrip('.').lower()
+        if not value.isascii():
+            value = value.encode('idna').decode('ascii')
+        if self.DOMAIN.match(value):
+            return value
+        return None
+
+
+    def ipv4(self, crits_type, value):
+        return str(ipaddress.IPv4Address(value.strip()))
+
+
+    def ipv6(self, crits_type, value):
+        return ipaddress.IPv6Address(value.strip()).compressed
+
+
+    def ipv4_subnet(self, crits_type, value):
+        return str(ipaddress.IPv4Network(value.strip(), strict=False))
+
+
+    def email(self, crits_type, value):
+        value = value.strip()
+        match = self.EMAIL.match(value)
+        if not match:
+            return None
+        local, _, domain = value.rpartition('@')
+        domain = self.domain(it.DOMAIN, domain)
+        if not domain:
+            return None
+        return '{}@{}'.format(local, domain)
+
+
+    def uri(self, crits_type, value):
+        value = value.strip()
+        match = self.URL_HOST.match(value)
+        if match:
+            value = match.group(1).lower() + match.group(2).lower() + \
+                (match.group(3) or '')
+        return value
+
+
+def iter_pulse_json(pulse, codec=JSON_CODEC):
+    '''
+    Serializes a pulse as one line of JSON in UTF-8, one indicator at a
+    time, so a streamed pulse is never held in memory as a whole
+    '''
+    # Everything but the closing brace
+    yield codec.dumps(pulse.meta())[:-1]
+    yield b',"indicators":['
+    for n, i in enumerate(pulse.indicators):
+        if n:
+            yield b','
+        yield codec.dumps({'type': i.type, 'indicator': i.indicator})
+    yield b']}\n'
+
+
+class SpoolWriter(object):
+    '''
+    Appends pulses to gzip-compressed JSON lines segments in the spool
+    directory. Each pulse is written as its own gzip member, so the segment
+    is still a valid .jsonl.gz file and a reader can start at the byte
+    offset of any pulse. The segment being written carries a .part suffix
+    and is renamed once it reaches segment_size bytes or the writer closes.
+    Segment names include the pid and a random tag, so several writers can
+    share a spool directory. Each writer holds an flock on its .part file
+    for as long as it writes to it.
+    '''
+    SUFFIX = '.jsonl.gz'
+
+    def __init__(self, spool_dir, segment_size, compression_level=6,
+                 codec=JSON_CODEC):
+        if not os.path.isdir(spool_dir):
+            os.makedirs(spool_dir)
+        self.spool_dir = spool_dir
+        self.segment_size = segment_size
+        self.compression_level = compression_level
+        self.codec = codec
+        self.file = None
+        self.path = None
+        self.written = 0
+        # A crashed fetch leaves its last segment behind. Readers stop at a
+        # truncated pulse, so the segment can simply be finished. Segments
+        # whose lock is still held belong to a live writer.
+        for name in sorted(os.listdir(spool_dir)):
+            if name.endswith(self.SUFFIX + '.part'):
+                self._recover(os.path.join(spool_dir, name))
+
+
+    def _recover(self, path):
+        try:
+            part = open(path, 'ab')
+        except (IOError, OSError):
+            # Finished by its writer or another recovery meanwhile
+            return
+        with part:
+            try:
+                fcntl.flock(part.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                return
+            try:
+                os.rename(path, path[:-len('.part')])
+            except OSError:
+                pass
+
+
+    def _open(self):
+        name = 'pulses-{}-{}-{:08x}{}'.format(
+            datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'), os.getpid(),
+            random.getrandbits(32), self.SUFFIX)
+        self.path = os.path.join(self.spool_dir, name + '.part')
+        # The segment is locked under a hidden name first, so there is no
+        # moment when its .part name exists without a lock on it
+        staging = os.path.join(self.spool_dir, '.' + name + '.new')
+        self.file = open(staging, 'ab')
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        os.rename(staging, self.path)
+
+
+    def _finish_segment(self):
+        if self.file is None:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        # Renamed while still locked, so no recovery can get in between
+        os.rename(self.path, self.path[:-len('.part')])
+        self.file.close()
+        self.file = None
+        self.path = None
+
+
+    def write(self, pulse):
+        if self.file is None:
+            self._open()
+        compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        for chunk in iter_pulse_json(pulse, self.codec):
+            self.file.write(compressor.compress(chunk))
+        self.file.write(compressor.flush())
+        self.file.flush()
+        self.written += 1
+        if self.file.tell() >= self.segment_size:
+            self._finish_segment()
+
+
+    def close(self):
+        self._finish_segment()
+
+
+class SpoolReader(object):
+    '''
+    Reads pulses back from the finished segments of a spool directory, in
+    the order they were written. Each pulse comes with its position, the
+    (segment, byte offset) just past it, which is where a later read can
+    pick up again.
+    '''
+
+    def __init__(self, spool_dir, streaming=False, chunk_size=65536,
+                 codec=JSON_CODEC):
+        self.spool_dir = spool_dir
+        self.streaming = streaming
+        self.chunk_size = chunk_size
+        self.codec = codec
+
+
+    def segments(self):
+        if not os.path.isdir(self.spool_dir):
+            return []
+        return sorted(name for name in os.listdir(self.spool_dir)
+                      if name.endswith(SpoolWriter.SUFFIX))
+
+
+    def read(self, position=None):
+        '''
+        Yields (pulse, position) for every pulse after the given position.
+        With no position, starts from the oldest segment.
+        '''
+        for segment in self.segments():
+            offset = 0
+            if position is not None:
+                if segment < position[0]:
+                    continue
+                if segment == position[0]:
+                    offset = position[1]
+            with open(os.path.join(self.spool_dir, segment), 'rb') as f:
+                f.seek(offset)
+                while True:
+                    body, size = self._read_member(f, segment, offset)
+                    if body is None:
+                        break
+                    offset += size
+                    yield self._decode(body), (segment, offset)
+
+
+    def _read_member(self, f, segment, offset):
+        '''
+        Decompresses the gzip member at the file's position into a temporary
+        file. Returns the file and the compressed size of the member, or
+        (None, 0) at the end of the segment.
+        '''
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        body = tempfile.SpooledTemporaryFile(max_size=1 << 20)
+        size = 0
+        while not decompressor.eof:
+            data = f.read(self.chunk_size)
+            if not data:
+                if size:
+                    print('Spool segment {} ends with a truncated pulse at '
+                          'byte {}'.format(segment, offset))
+                body.close()
+                return None, 0
+            size += len(data)
+            body.write(decompressor.decompress(data))
+        # Step back over whatever belongs to the next member
+        unused = len(decompressor.unused_data)
+        if unused:
+            f.seek(-unused, os.SEEK_CUR)
+        body.seek(0)
+        return body, size - unused
+
+
+    def _decode(self, body):
+        if not self.streaming:
+            with body:
+                return Pulse.from_otx(self.codec.loads(body.read()))
+        lock = threading.Lock()
+        reader = JSONStreamReader(body, lock=lock)
+        # The indicators are read from body later, so it stays open until
+        # the pulse is garbage collected
+        return Pulse.from_otx(read_streamed_pulse(reader, body, lock))
+
+
+class SpoolProgress(object):
+    '''
+    Keeps the position in the spool up to which every pulse has been
+    imported. Workers finish pulses out of order, so the stored position
+    only moves across an unbroken run of finished pulses. A failed pulse
+    holds it back, and the next import starts again from that pulse. Any
+    pulses after it that did finish are skipped using the local index.
+    '''
+    KEY = 'spool_position'
+
+    def __init__(self, index, key=KEY):
+        self.index = index
+        self.key = key
+        self.lock = threading.Lock()
+        stored = index.get_meta(key)
+        self.position = tuple(json.loads(stored)) if stored else None
+        self.next_seq = 0
+        self.done_seq = 0
+        self.pending = {}
+        self.finished = {}
+
+
+    def track(self, items):
+        '''
+        Passes through the pulses of SpoolReader.read, remembering where each
+        one ends
+        '''
+        for pulse, position in items:
+            with self.lock:
+                self.pending[id(pulse)] = (self.next_seq, position)
+                self.next_seq += 1
+            yield pulse
+
+
+    def commit(self, pulse, result):
+        with self.lock:
+            seq, position = self.pending.pop(id(pulse))
+            if result.status in (PulseResult.FAILED, PulseResult.DEFERRED):
+                position = None
+            self.finished[seq] = position
+            moved = False
+            while self.finished.get(self.done_seq) is not None:
+                self.position = self.finished.pop(self.done_seq)
+                self.done_seq += 1
+                moved = True
+            if moved:
+                self.index.set_meta(self.key, json.dumps(self.position))
+
+
+class OTX2CRITs(object):
+
+    # fetch walks OTX into the spool, import drains the spool into CRITs and
+    # sync does both at once without a spool
+    MODES = ('sync', 'fetch', 'import')
+
+    def __init__(self, dev=False, config=None, days=None, full=False,
+                 mode='sync', update=False, target=None, shard=None):
+        # Load the configuration
+        self.config = self.load_config(config)
+
+        # Now we're talkin
+        self.otx_api_key = self.config.get('otx', 'otx_api_key')
+        self.otx_url = self.config.get('otx', 'otx_url')
+
+        # JSON for every OTX response, CRITs payload and the spool
+        self.codec = JSONCodec(self.config.get('json', 'backend',
+                                               fallback='auto'))
+
+        self.proxies = {
+            'http' : self.config.get('proxy', 'http'),
+            'https' : self.config.get('proxy', 'https'),
+        }
+
+        # The CRITs instance to import into. prod and dev come from the
+        # prod_/dev_ options of [crits]; any other target has a
+        # [crits:<name>] section whose options override those of [crits].
+        self.crits_target = target or ('dev' if dev else 'prod')
+        self.crits_sections = ('crits:{}'.format(self.crits_target), 'crits')
+        if self.config.has_section(self.crits_sections[0]):
+            self.crits_url = self.get_crits_option('url')
+            self.crits_api_key = self.get_crits_option('api_key')
+        elif self.crits_target in ('prod', 'dev'):
+            self.crits_url = self.config.get(
+                'crits', '{}_url'.format(self.crits_target))
+            self.crits_api_key = self.config.get(
+                'crits', '{}_api_key'.format(self.crits_target))
+        else:
+            raise ValueError('No [{}] section in the config for CRITs target '
+                             '{}'.format(self.crits_sections[0],
+                                         self.crits_target))
+        self.crits_username = self.get_crits_option('username')
+        self.crits_verify = self.get_crits_option(
+            'verify', getter=ConfigParser.getboolean)
+        # Send up to this many indicators, or relationships of an event, in
+        # one call, for CRITs APIs that accept batches. Stock CRITs takes one
+        # object per call; batching turns itself off on the first batch
+        # such an API rejects.
+        self.bulk_size = self.get_crits_option('bulk_size', fallback=0,
+                                               getter=ConfigParser.getint)
+        self.bulk_supported = {'indicators': True, 'relationships': True}
+        self.crits_source = self.get_crits_option('source')
+        if self.crits_url[-1] == '/':
+            self.crits_url = self.crits_url[:-1]
+
+        self.crits_proxies = {
+            'http' : self.get_crits_option('crits_proxy'),
+            'https' : self.get_crits_option('crits_proxy'),
+        }
+
+        # Local state (the pulse index and friends) lives here, one database
+        # per CRITs instance so dev and prod never share an index
+        self.state_dir = os.path.expanduser(
+            self.config.get('state', 'state_dir', fallback='~/.otx2crits'))
+        self.state = PulseIndex(os.path.join(self.state_dir,
+                                '{}.db'.format(self.crits_target)))
+        self.index = None
+        if self.config.getboolean('state', 'use_index', fallback=True):
+            self.index = self.state
+
+        # Add the new indicators of pulses that changed after they were
+        # imported, instead of skipping them. This needs the local index.
+        self.update = update
+        if update and self.index is None:
+            print('Updating modified pulses needs use_index = true, they '
+                  'will be skipped')
+
+        # Record each step of a pulse as it completes, so a pulse that was
+        # cut short is resumed where it stopped
+        self.journal = None
+        if self.config.getboolean('state', 'journal', fallback=True):
+            self.journal = self.state
+
+        # Canonicalize and validate indicators, and drop duplicates within a
+        # pulse, before anything is sent to CRITs. filtered counts what was
+        # changed or dropped over the whole run.
+        self.normalizer = None
+        if self.config.getboolean('crits', 'normalize_indicators',
+                                  fallback=True):
+            self.normalizer = IndicatorNormalizer(self.get_indicator_mapping())
+        # Give the known OTX types the low type codes
+        for otx_type in sorted(self.get_indicator_mapping()):
+            INDICATOR_TYPES.code(otx_type)
+        self.lock = threading.Lock()
+        self.filtered = {}
+        # Set by stop() to wind down a run, e.g. on SIGTERM
+        self.stopping = threading.Event()
+
+        # Set by execute when indicators are added in parallel
+        self.indicator_pool = None
+        self.indicator_workers = 1
+
+        # Remember the CRITs ids of indicators we've already added
+        self.indicator_cache = None
+        cache_size = self.config.getint('state', 'indicator_cache_size',
+                                        fallback=100000)
+        if cache_size > 0:
+            self.indicator_cache = IndicatorCache(cache_size)
+        self.persist_indicator_cache = self.config.getboolean(
+            'state', 'persist_indicator_cache', fallback=True)
+        if self.indicator_cache is not None and self.persist_indicator_cache:
+            self.indicator_cache.load(self.state)
+
+        # Pulses fetched from OTX can be spooled to disk and imported later
+        self.mode = mode
+        self.spool_dir = os.path.expanduser(self.config.get(
+            'spool', 'spool_dir',
+            fallback=os.path.join(self.state_dir, 'spool')))
+        self.spool_segment_size = int(self.config.getfloat(
+            'spool', 'segment_size_mb', fallback=64) * 1024 * 1024)
+
+        # With shard=(index, count), only pulses that hash to this shard are
+        # handled, and pulses are claimed in the lease database first so
+        # that no two workers ever import the same one
+        self.shard = shard
+        self.leases = None
+        if shard is not None:
+            print('Handling shard {} of {}'.format(shard[0], shard[1]))
+            if mode != 'fetch':
+                self.leases = LeaseStore(
+                    os.path.expanduser(self.config.get(
+                        'shard', 'lease_db',
+                        fallback=os.path.join(self.state_dir, 'leases.db'))),
+                    self.crits_target,
+                    ttl=self.config.getfloat('shard', 'lease_ttl',
+                                             fallback=300))
+
+        # Remember how far we got so the next run only asks OTX for what
+        # changed since then. Fetching into the spool keeps its own mark,
+        # and so does each shard.
+        self.checkpoint = None
+        if mode != 'import' and \
+                self.config.getboolean('state', 'checkpoint', fallback=True):
+            key = 'fetch_mark' if mode == 'fetch' else SyncCheckpoint.KEY
+            self.checkpoint = SyncCheckpoint(self.state,
+                                             key=self.shard_key(key))
+
+        self.modified_since = self.get_modified_since(days, full)
+        # Cleared by get_pulse_pages if a page of pulses can't be read
+        self.walk_complete = True
+
+        # How many pulses to request per OTX page, and how many pages to
+        # fetch ahead of the import while CRITs is busy
+        self.page_size = self.config.getint('otx', 'page_size', fallback=10)
+        self.page_size = max(1, min(self.page_size, OTX_MAX_PAGE_SIZE))
+        self.prefetch_pages = self.config.getint('otx', 'prefetch_pages',
+                                                 fallback=2)
+        # Spool pages to disk and parse them incrementally instead of
+        # decoding whole pages in memory
+        self.streaming = self.config.getboolean('otx', 'streaming',
+                                                fallback=False)
+        # List just the ids and modified times of pulses first, and only
+        # download the pulses we don't have yet, detail_workers at a time
+        self.two_phase = self.config.getboolean('otx', 'two_phase',
+                                                fallback=False)
+        self.detail_workers = max(1, self.config.getint(
+            'otx', 'detail_workers', fallback=4))
+
+        # Shared HTTP sessions so every call reuses pooled keep-alive
+        # connections instead of paying a new TCP+TLS handshake
+        self.otx_pool_size = self.config.getint('otx', 'pool_size',
+                                                fallback=10)
+        self.crits_pool_size = self.get_crits_option(
+            'pool_size', fallback=10, getter=ConfigParser.getint)
+        self.otx_session = self.build_session(self.otx_pool_size,
+                                              proxies=self.proxies)
+        self.otx_session.headers['X-OTX-API-KEY'] = self.otx_api_key
+        # Pages of pulses with their indicators compress very well
+        self.otx_session.headers['Accept-Encoding'] = 'gzip, deflate'
+        # Pages and pulses that haven't changed since the last run are
+        # served from disk after a conditional request
+        self.otx_cache = None
+        if self.config.getboolean('otx', 'http_cache', fallback=True):
+            self.otx_cache = HTTPCache(
+                os.path.expanduser(self.config.get(
+                    'otx', 'http_cache_dir',
+                    fallback=os.path.join(self.state_dir, 'otx-cache'))),
+                int(self.config.getfloat('otx', 'http_cache_size_mb',
+                                         fallback=256) * 1024 * 1024),
+                namespace=self.otx_api_key)
+        self.crits_session = self.build_session(self.crits_pool_size,
+                                                proxies=self.crits_proxies,
+                                                verify=self.crits_verify)
+        # CRITs authenticates every API call with these
+        self.crits_session.params = {
+            'username' : self.crits_username,
+            'api_key' : self.crits_api_key,
+        }
+
+        # Per-stage timings, call counts and bytes for the run summary
+        self.metrics = Metrics()
+
+        # Every OTX and CRITs call is rate limited and retried through these
+        self.otx_control = self.build_rate_control('OTX', 'otx',
+                                                   self.otx_pool_size)
+        self.crits_control = self.build_rate_control(
+            'CRITs {}'.format(self.crits_target), self.crits_sections,
+            self.crits_pool_size)
+
+
+    def get_modified_since(self, days=None, full=False):
+        '''
+        Works out how far back to ask OTX for pulses: the last given number
+        of days, or else the sync mark unless a full walk was asked for
+        '''
+        if self.mode == 'import':
+            return None
+        if days:
+            print('Searching for pulses modified in the last {} '
+                  'days'.format(days))
+            return datetime.datetime.now() - datetime.timedelta(days=days)
+        if not full and self.checkpoint is not None and self.checkpoint.mark:
+            print('Searching for pulses modified since the last sync at '
+                  '{}'.format(self.checkpoint.mark))
+            return self.checkpoint.mark
+        return None
+
+
+    def new_cycle(self):
+        '''
+        Resets the per-run state so a long-lived instance can run again with
+        its sessions and caches still warm. The next run picks up from the
+        sync mark.
+        '''
+        self.modified_since = self.get_modified_since()
+        self.walk_complete = True
+        with self.lock:
+            self.filtered = {}
+        self.metrics.reset()
+
+
+    def shard_key(self, key):
+        '''
+        Names a state database key after this worker's shard, so workers
+        sharing a database keep separate marks
+        '''
+        if self.shard is None:
+            return key
+        return '{}:{}/{}'.format(key, self.shard[0], self.shard[1])
+
+
+    def shard_filter(self, iterable, key=lambda pulse: pulse):
+        '''
+        Yields only the items whose pulse belongs to this worker's shard
+        '''
+        if self.shard is None:
+            for item in iterable:
+                yield item
+            return
+        index, count = self.shard
+        for item in iterable:
+            if shard_of(key(item).id, count) == index:
+                yield item
+
+
+    def until_stopped(self, iterable):
+        '''
+        Yields from iterable until stop() is called. Pulses already handed
+        out still finish, but a stopped walk counts as incomplete so the
+        sync mark stays where it was.
+        '''
+        for item in iterable:
+            if self.stopping.is_set():
+                print('Stopping, no more pulses will be started')
+                self.walk_complete = False
+                return
+            yield item
+
+
+    def stop(self):
+        self.stopping.set()
+
+
+    def close(self):
+        '''
+        Releases the HTTP sessions and the state database
+        '''
+        self.otx_session.close()
+        self.crits_session.close()
+        self.state.close()
+        if self.otx_cache is not None:
+            self.otx_cache.close()
+        if self.leases is not None:
+            self.leases.close()
+
+
+    def execute(self, workers=1, indicator_workers=1, pulses=None,
+                progress=None):
+        '''
+        Imports every pulse from the OTX pulse generator into CRITs. With more
+        than one worker, independent pulses are imported in parallel. Each
+        pulse still runs its own steps in order (event, ticket, indicators,
+        relationships). With more than one indicator worker, the indicator
+        and relationship calls within a pulse are also made in parallel,
+        through one pool shared by all pulses. Returns the list of
+        PulseResult objects.
+
+        Other sources of pulses, such as the spool, can be passed in as
+        pulses, with a progress object whose commit(pulse, result) is called
+        as each one finishes.
+        '''
+        from_otx = pulses is None
+        if from_otx:
+            pulses = self.get_pulse_generator(modified_since=\
+                                              self.modified_since)
+            pulses = self.time_iterator(self.shard_filter(pulses), 'otx_wait')
+        pulses = self.until_stopped(pulses)
+        commit = progress.commit if progress is not None else self.commit_pulse
+        results = []
+        if self.journal is not None:
+            unfinished = self.journal.unfinished_journals()
+            if unfinished:
+                print('{} pulses were left unfinished, they are resumed as '
+                      'they come up'.format(unfinished))
+        self.indicator_workers = indicator_workers
+        if indicator_workers > 1:
+            print('Adding indicators with {} workers'.format(indicator_workers))
+            self.indicator_pool = ThreadPoolExecutor(
+                max_workers=indicator_workers)
+        try:
+            if workers > 1:
+                print('Importing pulses with {} workers'.format(workers))
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    for pulse, future in bounded_map(pool, self.import_pulse,
+                                                     pulses, workers * 2):
+                        results.append(future.result())
+                        commit(pulse, results[-1])
+            else:
+                for pulse in pulses:
+                    results.append(self.import_pulse(pulse))
+                    commit(pulse, results[-1])
+        finally:
+            if self.indicator_pool is not None:
+                self.indicator_pool.shutdown()
+                self.indicator_pool = None
+
+        self.print_summary(results)
+        if from_otx and self.checkpoint is not None:
+            self.checkpoint.finish(self.walk_complete, self.modified_since)
+        if self.otx_cache is not None and from_otx:
+            print(self.otx_cache.stats())
+        if self.indicator_cache is not None:
+            print(self.indicator_cache.stats())
+            if self.persist_indicator_cache:
+                self.indicator_cache.save(self.state)
+        return results
+
+
+    def fetch_to_spool(self):
+        '''
+        Walks the subscribed pulses on OTX and appends them to the spool
+        without touching CRITs. Returns the number of pulses spooled.
+        '''
+        writer = SpoolWriter(self.spool_dir, self.spool_segment_size,
+                             codec=self.codec)
+        print('Spooling pulses to {}'.format(self.spool_dir))
+        pulses = self.get_pulse_generator(modified_since=self.modified_since)
+        try:
+            pulses = self.until_stopped(self.time_iterator(
+                self.shard_filter(pulses), 'otx_wait'))
+            for pulse in pulses:
+                with self.metrics.timer('spool_write'):
+                    writer.write(pulse)
+                if self.checkpoint is not None:
+                    self.checkpoint.commit(pulse)
+        finally:
+            writer.close()
+        print('Spooled {} pulses'.format(writer.written))
+        if self.otx_cache is not None:
+            print(self.otx_cache.stats())
+        if self.checkpoint is not None:
+            self.checkpoint.finish(self.walk_complete, self.modified_since)
+        return writer.written
+
+
+    def import_spool(self, workers=1, indicator_workers=1, position=None):
+        '''
+        Imports the pulses in the spool into CRITs, starting where the last
+        import of this CRITs instance stopped, or at the given (segment,
+        byte offset) position. Returns the list of PulseResult objects.
+        '''
+        progress = SpoolProgress(self.state,
+                                 key=self.shard_key(SpoolProgress.KEY))
+        if position is None:
+            position = progress.position
+        if position:
+            print('Importing from spool segment {} at byte {}'.format(
+                *position))
+        reader = SpoolReader(self.spool_dir, streaming=self.streaming,
+                             codec=self.codec)
+        pulses = progress.track(self.shard_filter(reader.read(position),
+                                                  key=lambda item: item[0]))
+        pulses = self.time_iterator(pulses, 'spool_read')
+        return self.execute(workers=workers,
+                            indicator_workers=indicator_workers,
+                            pulses=pulses, progress=progress)
+
+
+    def time_iterator(self, iterable, stage):
+        '''
+        Yields from iterable, recording how long each item took to arrive.
+        For the pulse generator this is the time the import sat waiting on
+        OTX.
+        '''
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.metrics.observe(stage, time.time() - start)
+            yield item
+
+
+    def write_metrics(self, results, json_path=None, prom_path=None):
+        '''
+        Builds the run summary and returns it, writing it as JSON and/or as
+        a Prometheus textfile if paths are given
+        '''
+        now = time.time()
+        counts = {}
+        for result in results:
+            counts[result.status] = counts.get(result.status, 0) + 1
+        services = {}
+        for control in (self.otx_control, self.crits_control):
+            services[control.name] = {
+                'retries' : control.retries,
+                'throttled' : control.throttled,
+                'concurrency' : control.limit,
+            }
+        summary = {
+            'started' : datetime.datetime.fromtimestamp(
+                self.metrics.started).isoformat(),
+            'finished' : datetime.datetime.fromtimestamp(now).isoformat(),
+            'duration_seconds' : now - self.metrics.started,
+            'crits_target' : self.crits_target,
+            'mode' : self.mode,
+            'walk_complete' : self.walk_complete,
+            'pulses' : counts,
+            'stages' : self.metrics.summary(),
+            'services' : services,
+            'indicators_filtered' : self.filtered,
+        }
+        if self.indicator_cache is not None:
+            summary['indicator_cache'] = {
+                'hits' : self.indicator_cache.hits,
+                'misses' : self.indicator_cache.misses,
+                'entries' : len(self.indicator_cache),
+            }
+        if self.otx_cache is not None:
+            summary['otx_cache'] = {
+                'hits' : self.otx_cache.hits,
+                'misses' : self.otx_cache.misses,
+            }
+        if json_path:
+            write_atomically(json_path, json.dumps(summary, indent=2,
+                                                   sort_keys=True) + '\n')
+            print('Run summary written to {}'.format(json_path))
+        if prom_path:
+            target = {'target': self.crits_target}
+            gauges = [
+                ('otx2crits_last_run_timestamp_seconds', target, now,
+                 'When the last run finished.'),
+                ('otx2crits_last_run_duration_seconds', target,
+                 summary['duration_seconds'], 'How long the last run took.'),
+                ('otx2crits_last_run_walk_complete', target,
+                 int(self.walk_complete), 'Whether the last run read every '
+                 'page of pulses.'),
+            ]
+            for status in (PulseResult.IMPORTED, PulseResult.UPDATED,
+                           PulseResult.SKIPPED, PulseResult.DEFERRED,
+                           PulseResult.FAILED):
+                gauges.append(('otx2crits_last_run_pulses',
+                               dict(target, status=status),
+                               counts.get(status, 0),
+                               'Pulses handled by the last run, by outcome.'))
+            for key, description in (
+                    ('retries', 'Calls retried during the last run.'),
+                    ('throttled', 'Times each service throttled or failed '
+                     'calls during the last run.')):
+                for name, stats in sorted(services.items()):
+                    gauges.append(('otx2crits_last_run_{}'.format(key),
+                                   dict(target, service=name), stats[key],
+                                   description))
+            for reason in ('normalized', 'duplicate', 'invalid'):
+                gauges.append(('otx2crits_last_run_indicators_filtered',
+                               dict(target, reason=reason),
+                               self.filtered.get(reason, 0),
+                               'Indicators changed or dropped by '
+                               'normalization in the last run, by reason.'))
+            if 'indicator_cache' in summary:
+                for key in ('hits', 'misses', 'entries'):
+                    gauges.append(('otx2crits_indicator_cache_{}'.format(key),
+                                   target, summary['indicator_cache'][key],
+                                   'Indicator cache {} in the last '
+                                   'run.'.format(key)))
+            if 'otx_cache' in summary:
+                for key in ('hits', 'misses'):
+                    gauges.append(('otx2crits_otx_cache_{}'.format(key),
+                                   target, summary['otx_cache'][key],
+                                   'OTX response cache {} in the last '
+                                   'run.'.format(key)))
+            write_atomically(prom_path, self.metrics.prometheus(gauges,
+                                                               target))
+            print('Prometheus metrics written to {}'.format(prom_path))
+        return summary
+
+
+    def commit_pulse(self, pulse, result):
+        '''
+        Records that a pulse is done, for the sync checkpoint
+        '''
+        if self.checkpoint is None:
+            return
+        if result.status == PulseResult.FAILED:
+            self.checkpoint.fail(pulse)
+        elif result.status == PulseResult.DEFERRED:
+            self.checkpoint.defer(pulse)
+        else:
+            self.checkpoint.commit(pulse)
+
+
+    def import_pulse(self, pulse):
+        '''
+        Imports a single pulse into CRITs. Errors are caught and reported in
+        the returned PulseResult so one bad pulse doesn't stop the others.
+        '''
+        if self.leases is not None:
+            claim = self.leases.claim(pulse.id, redo=self.update)
+            if claim == LeaseStore.DONE and self.journal is not None:
+                # Finished by whoever took it over from this worker
+                self.journal.finish_journal(pulse.id)
+            if claim == LeaseStore.DONE:
+                print('Pulse {} is done by another worker'.format(pulse.id))
+                return PulseResult(pulse.id, pulse.name,
+                                   PulseResult.SKIPPED,
+                                   'Imported by another worker')
+            if claim != LeaseStore.CLAIMED:
+                print('Pulse {} is claimed by another worker'.format(
+                    pulse.id))
+                return PulseResult(pulse.id, pulse.name,
+                                   PulseResult.DEFERRED,
+                                   'Claimed by another worker')
+        result = None
+        try:
+            with self.metrics.timer('pulse_import') as timer:
+                result = self._import_pulse(pulse)
+                if result.status == PulseResult.FAILED:
+                    timer.fail()
+                return result
+        except Exception as e:
+            print('Error importing pulse {}: {}'.format(pulse.id, e))
+            result = PulseResult(pulse.id, pulse.name,
+                                 PulseResult.FAILED,
+                                 'Unhandled error: {}'.format(e))
+            return result
+        finally:
+            if self.leases is not None:
+                self.leases.release(pulse.id, done=result is not None and
+                                    result.status != PulseResult.FAILED)
+
+
+    def _import_pulse(self, pulse):
+        print('Found pulse with id {} and title {}'.format(pulse.id,
+                                                           pulse.name.encode("utf-8")))
+        journal = None
+        if self.journal is not None:
+            journal = self.journal.get_journal(pulse.id)
+        if journal is not None and journal['event_id']:
+            return self.resume_pulse(pulse, journal)
+        if self.leases is not None:
+            # Left unfinished by a worker that may have had another journal
+            pending = self.leases.get_pending(pulse.id)
+            if pending is not None:
+                if self.journal is not None:
+                    self.journal.begin_journal(pulse.id, pending['event_id'],
+                                               ticket=pending['ticket'])
+                return self.resume_pulse(pulse, pending)
+        if self.is_pulse_in_crits(pulse.id):
+            if self.update and self.index is not None:
+                return self.update_pulse(pulse)
+            print('Pulse was already in CRITs')
+            return PulseResult(pulse.id, pulse.name,
+                               PulseResult.SKIPPED, 'Already in CRITs')
+
+        print('Adding pulse {} to CRITs.'.format(pulse.name.encode("utf-8")))
+        # Get the actual event data from the pulse
+        event_title = pulse.name
+        created = pulse.created
+        reference =''
+        if not reference:
+
+            reference = 'No reference documented'
+        else:
+            reference = pulse.references[0]
+
+        description = pulse.description
+        bucket_list = pulse.tags
+
+        # CRITs requires a description
+        if description == '':
+            description = 'No description given.'
+
+        # Create the CRITs event first
+        if journal is not None:
+            print('Pulse was cut short before its Event was recorded, '
+                  'adding it again')
+        if self.journal is not None:
+            self.journal.begin_journal(pulse.id)
+        print('Adding Event to CRITs with title {}'.format(event_title.encode("utf-8")))
+        params = {
+            'bucket_list' : ','.join(bucket_list),
+            'description' : description,
+            'reference' : reference,
+            'method' : 'otx2crits',
+        }
+        event = self.build_crits_event(event_title, self.crits_source,
+                                       description, params=params)
+        if 'id' not in event:
+            print('id not found in event object returned from crits!')
+            print('Event object was: {}'.format(repr(event)))
+            print('Skipping event: {}.'.format(event_title))
+            if self.journal is not None:
+                self.journal.finish_journal(pulse.id)
+            return PulseResult(pulse.id, pulse.name, PulseResult.FAILED,
+                               'CRITs did not return an event id')
+        event_id = event['id']
+        if self.journal is not None:
+            self.journal.journal_event(pulse.id, event_id)
+        if self.leases is not None:
+            self.leases.journal_event(pulse.id, event_id)
+
+        # Add a ticket to the Event to track the pulse_id
+        # This goes above the indicators because sometimes adding
+        # indicators fails and we end up with many duplicate events.
+        print('Adding ticket to Event {}'.format(event_title.encode("utf-8")))
+        success = self.add_ticket_to_crits_event(event_id, pulse.id)
+        if not success:
+            print('Forging on after a ticket error.')
+        else:
+            self.journal_ticket(pulse.id)
+        # Record the pulse locally even if the ticket failed, otherwise the
+        # next run would not find it and would create a duplicate event
+        if self.index is not None:
+            self.index.add(pulse.id, event_id)
+
+        count, failures, filtered = self.import_pulse_indicators(pulse,
+                                                                 event_id)
+        message = self.describe_indicators('{} indicators'.format(count),
+                                           failures, filtered)
+        return PulseResult(pulse.id, pulse.name, PulseResult.IMPORTED,
+                           message, failures=failures)
+
+
+    def resume_pulse(self, pulse, journal):
+        '''
+        Finishes a pulse that an earlier run left half imported, starting
+        after the last step its journal recorded. Indicators and
+        relationships that were already done are not sent again.
+        '''
+        event_id = journal['event_id']
+        print('Resuming pulse {} with Event {}: {} indicators and {} '
+              'relationships were already done'.format(
+                  pulse.id, event_id, len(journal['indicators']),
+                  len(journal['related'])))
+        if self.leases is not None:
+            self.leases.journal_event(pulse.id, event_id)
+            if journal['ticket']:
+                self.leases.journal_ticket(pulse.id)
+        if not journal['ticket']:
+            if self.add_ticket_to_crits_event(event_id, pulse.id):
+                self.journal_ticket(pulse.id)
+            else:
+                print('Forging on after a ticket error.')
+        if self.index is not None and pulse.id not in self.index:
+            self.index.add(pulse.id, event_id)
+
+        # An update that was cut short still leaves out what the pulse had
+        # before
+        known = self.state.get_pulse_indicators(pulse.id)
+        count, failures, filtered = self.import_pulse_indicators(
+            pulse, event_id, known=known, journal=journal)
+        message = self.describe_indicators('{} indicators, resumed'.format(
+            count), failures, filtered)
+        return PulseResult(pulse.id, pulse.name, PulseResult.IMPORTED,
+                           message, failures=failures)
 
-class OTX2CRITs(object):
 
-    def __init__(self, dev=False, config=None, days=None):
-        # Load the configuration
-        self.config = self.load_config(config)
+    def journal_ticket(self, pulse_id):
+        if self.journal is not None:
+            self.journal.journal_ticket(pulse_id)
+        if self.leases is not None:
+            self.leases.journal_ticket(pulse_id)
 
-        # Now we're talkin
-        self.otx_api_key = self.config.get('otx', 'otx_api_key')
-        self.otx_url = self.config.get('otx', 'otx_url')
 
-        self.proxies = {
-            'http' : self.config.get('proxy', 'http'),
-            'https' : self.config.get('proxy', 'https'),
-        }
+    def update_pulse(self, pulse):
+        '''
+        Brings a pulse that is already in CRITs up to date by adding and
+        relating only the indicators that were not imported before. Pulses
+        whose OTX modified time hasn't changed since they were last fully
+        imported are skipped without looking at their indicators.
+        '''
+        pulse_id = pulse.id
+        modified = pulse.modified
+        imported_modified = self.index.get_modified(pulse_id)
+        if modified and imported_modified == modified:
+            print('Pulse was already in CRITs and has not changed')
+            return PulseResult(pulse_id, pulse.name, PulseResult.SKIPPED,
+                               'Already in CRITs')
+        if imported_modified == PulseIndex.UNTRACKED:
+            return self.track_pulse(pulse)
+        event_id = self.index.get_event_id(pulse_id)
+        if not event_id:
+            return PulseResult(pulse_id, pulse.name, PulseResult.FAILED,
+                               'The CRITs event for this pulse is unknown')
+        known = self.state.get_pulse_indicators(pulse_id)
+        print('Updating pulse {} ({} indicators already imported)'.format(
+            pulse_id, len(known)))
+        if self.journal is not None:
+            self.journal.begin_journal(pulse_id, event_id, ticket=True)
+        count, failures, filtered = self.import_pulse_indicators(
+            pulse, event_id, known=known)
+        if not count and not failures:
+            return PulseResult(pulse_id, pulse.name, PulseResult.SKIPPED,
+                               'No new indicators')
+        message = self.describe_indicators('{} new indicators'.format(count),
+                                           failures, filtered)
+        return PulseResult(pulse_id, pulse.name, PulseResult.UPDATED,
+                           message, failures=failures)
 
-        self.crits_url = self.config.get('crits', 'prod_url')
-        self.crits_dev_url = self.config.get('crits', 'dev_url')
-        self.crits_username = self.config.get('crits', 'username')
-        self.crits_api_key = self.config.get('crits', 'prod_api_key')
-        self.crits_dev_api_key = self.config.get('crits', 'dev_api_key')
-        self.crits_verify = self.config.getboolean('crits', 'verify')
-        self.crits_source = self.config.get('crits', 'source')
-        if dev:
-            self.crits_url = self.crits_dev_url
-            self.crits_api_key = self.crits_dev_api_key
-        if self.crits_url[-1] == '/':
-            self.crits_url = self.crits_url[:-1]
 
-        self.crits_proxies = {
-            'http' : self.config.get('crits', 'crits_proxy'),
-            'https' : self.config.get('crits', 'crits_proxy'),
-        }
+    def track_pulse(self, pulse):
+        '''
+        Records the indicators a pulse has now as imported, for a pulse that
+        was imported before they were tracked, so later updates start from
+        here instead of adding and relating every indicator again
+        '''
+        indicator_data = pulse.indicators
+        if self.normalizer is not None:
+            indicator_data = self.normalizer.normalize(indicator_data, {})
+        self.state.add_pulse_indicators(pulse.id, set(
+            (i.type, i.indicator) for i in indicator_data))
+        self.state.set_modified(pulse.id, pulse.modified)
+        print('Pulse was imported before its indicators were tracked, '
+              'recorded them as imported')
+        return PulseResult(pulse.id, pulse.name, PulseResult.SKIPPED,
+                           'Indicators recorded')
 
-        self.modified_since = None
-        if days:
-            print('Searching for pulses modified in the last {} '
-                  'days'.format(days))
-            self.modified_since = datetime.datetime.now()\
-                - datetime.timedelta(days=days)
 
-        # Get pycrits ready for magic
-        self.crits = pycrits(self.crits_url, self.crits_username,
-                             self.crits_api_key, proxies=self.crits_proxies,
-                             verify=self.crits_verify)
+    def import_pulse_indicators(self, pulse, event_id, known=None,
+                                journal=None):
+        '''
+        Adds a pulse's indicators to CRITs and relates them to its event,
+        leaving out the (OTX type, value) pairs in known. The indicators
+        that made it are recorded for the pulse, and once all of them have,
+        so is the pulse's modified time. Returns the number of indicators
+        related, a list of (indicator, reason) failures and the counts of
+        indicators changed or dropped by normalization.
+
+        With the journal of a pulse that is being resumed, the indicator ids
+        and relationships it recorded are reused instead of sent again.
+        '''
+        done = {}
+        related = set()
+        if journal is not None:
+            done = journal['indicators']
+            related = journal['related']
+        filtered = {}
+        indicator_data = pulse.indicators
+        if self.normalizer is not None:
+            indicator_data = self.normalizer.normalize(indicator_data,
+                                                       filtered)
+        if known:
+            indicator_data = (i for i in indicator_data
+                              if (i.type, i.indicator) not in known)
 
+        # Add the indicators to CRITs. Every indicator id is collected
+        # before any relationship is built.
+        indicator_ids, failures = self.add_pulse_indicators(
+            indicator_data, pulse_id=pulse.id, done=done)
+        if self.journal is not None:
+            # Indicators served from the cache, which may be gone by the
+            # time a resumed run needs them
+            self.journal.journal_indicators(pulse.id, (
+                (key, indicator_id) for key, indicator_id
+                in indicator_ids.items() if indicator_id))
+        relationship_map = []
+        seen = set()
+        for indicator_id in indicator_ids.values():
+            if indicator_id and indicator_id not in seen:
+                seen.add(indicator_id)
+                relationship_map.append(indicator_id)
 
-    def execute(self):
-        for pulse in self.get_pulse_generator(modified_since=\
-                                              self.modified_since,
-                                              proxies=self.proxies):
+        # Build the relationships between the event and indicators
+        print('Building relationships.')
+        unrelated = self.relate_pulse_indicators(
+            event_id, [_id for _id in relationship_map if _id not in related],
+            pulse_id=pulse.id)
+        failures.extend(unrelated)
 
-            # This will be used to track relationships
-            relationship_map = []
+        unrelated = set(_id for _id, _ in unrelated)
+        self.state.add_pulse_indicators(pulse.id, (
+            key for key, indicator_id in indicator_ids.items()
+            if indicator_id not in unrelated))
+        if not failures and pulse.modified:
+            self.state.set_modified(pulse.id, pulse.modified)
+        if self.journal is not None:
+            self.journal.finish_journal(pulse.id)
+        with self.lock:
+            for reason, count in filtered.items():
+                self.filtered[reason] = self.filtered.get(reason, 0) + count
+        return len(relationship_map) - len(unrelated), failures, filtered
+
+
+    def describe_indicators(self, message, failures, filtered):
+        '''
+        Adds the failed and filtered indicator counts to a pulse's summary
+        message
+        '''
+        if failures:
+            message += ', {} failed'.format(len(failures))
+        for reason in ('duplicate', 'invalid'):
+            if filtered.get(reason):
+                message += ', {} {} dropped'.format(filtered[reason], reason)
+        return message
 
-            print('Found pulse with id {} and title {}'.format(pulse['id'],
-                                                               pulse['name'].encode("utf-8")))
-            if self.is_pulse_in_crits(pulse['id']):
-                print('Pulse was already in CRITs')
-                continue
 
-            print('Adding pulse {} to CRITs.'.format(pulse['name'].encode("utf-8")))
-            # Get the actual indicator and event data from the pulse
-            indicator_data = pulse['indicators']
-            event_title = pulse['name']
-            created = pulse['created']
-            reference =''
-            if not reference:
+    def run_stage(self, func, items):
+        '''
+        Calls func on every item, in parallel on the indicator pool if there
+        is one, keeping at most twice the pool size in flight. Yields
+        (item, result, error) in completion order. An error for one item
+        never stops the others.
+        '''
+        if self.indicator_pool is None:
+            for item in items:
+                try:
+                    yield item, func(item), None
+                except Exception as e:
+                    yield item, None, e
+            return
+        for item, future in bounded_map(self.indicator_pool, func, items,
+                                        self.indicator_workers * 2):
+            try:
+                yield item, future.result(), None
+            except Exception as e:
+                yield item, None, e
+
+
+    def submit_batch(self, kind, items, bulk, single):
+        '''
+        Sends items to CRITs in one call through bulk(items), which returns
+        a (result, error) pair per item, None if CRITs doesn't take batches
+        of this kind, or False if the batch failed. A batch that fails is
+        split in half and sent again, down to single(item) calls. Returns
+        (item, result, error) for every item.
+        '''
+        if not items:
+            return []
+        if len(items) == 1 or not self.bulk_supported[kind]:
+            results = []
+            for item in items:
+                try:
+                    results.append((item, single(item), None))
+                except Exception as e:
+                    results.append((item, None, e))
+            return results
+        try:
+            outcomes = bulk(items)
+        except Exception as e:
+            print('Error sending a batch of {} {} to CRITs: {}'.format(
+                len(items), kind, e))
+            outcomes = False
+        if outcomes is None:
+            if self.bulk_supported[kind]:
+                print('CRITs does not accept batches of {}, sending them one '
+                      'at a time'.format(kind))
+                self.bulk_supported[kind] = False
+            return self.submit_batch(kind, items, bulk, single)
+        if outcomes is False:
+            half = len(items) // 2
+            print('A batch of {} {} failed, splitting it'.format(len(items),
+                                                                kind))
+            return self.submit_batch(kind, items[:half], bulk, single) + \
+                self.submit_batch(kind, items[half:], bulk, single)
+        return [(item, result, error)
+                for item, (result, error) in zip(items, outcomes)]
 
-                reference = 'No reference documented'
+
+    def add_pulse_indicators(self, indicator_data, pulse_id=None, done=None):
+        '''
+        Adds a pulse's indicators to CRITs. Returns a dictionary of
+        (OTX type, value) -> CRITs indicator id, with None for types we
+        don't import, and a list of (indicator, reason) failures. Ids in done
+        are reused, and new ones are journaled for pulse_id.
+        '''
+        mapping = self.get_indicator_mapping()
+        indicator_ids = collections.OrderedDict()
+        failures = []
+
+        def prepare(i):
+            '''
+            Returns the CRITs type of an indicator, or None if we don't
+            import it, and its id if we already know it
+            '''
+            if i.type in mapping:
+                _type = mapping[i.type]
             else:
-                reference = pulse['references'][0]
-
-            description = pulse['description']
-            bucket_list = pulse['tags']
-
-            # CRITs requires a description
-            if description == '':
-                description = 'No description given.'
-
-            # Create the CRITs event first
-            print('Adding Event to CRITs with title {}'.format(event_title.encode("utf-8")))
-            params = {
-                'bucket_list' : ','.join(bucket_list),
-                'description' : description,
-                'reference' : reference,
-                'method' : 'otx2crits',
-            }
-            event = self.build_crits_event(event_title, self.crits_source,
-                                           description, params=params)
-            if 'id' not in event:
-                print('id not found in event object returned from crits!')
-                print('Event object was: {}'.format(repr(event)))
-                print('Skipping event: {}.'.format(event_title))
-                continue
-            event_id = event['id']
-
-            # Add a ticket to the Event to track the pulse_id
-            # This goes above the indicators because sometimes adding
-            # indicators fails and we end up with many duplicate events.
-            print('Adding ticket to Event {}'.format(event_title.encode("utf-8")))
-            params = {
-                'api_key' : self.crits_api_key,
-                'username' : self.crits_username,
-            }
-            success = self.add_ticket_to_crits_event(event_id, pulse['id'],
-                                                params=params,
-                                                proxies=self.crits_proxies,
-                                                verify=self.crits_verify)
-            if not success:
-                print('Forging on after a ticket error.')
+                # We found an indicator with a type we don't support.
+                print("We don't support type {}".format(i.type))
+                return None, None
+            if _type == None:
+                return None, None
+            if done and (i.type, i.indicator) in done:
+                return _type, done[(i.type, i.indicator)]
+            if self.indicator_cache is not None:
+                indicator_id = self.indicator_cache.get(_type, i.indicator)
+                if indicator_id:
+                    return _type, indicator_id
+            return _type, None
+
+        def created(i, _type, result):
+            print('Indicator created: {}'.format(result))
+            indicator_id = result['id']
+            print('Indicator created with id: {}'.format(indicator_id))
+            if self.journal is not None and pulse_id:
+                self.journal.journal_indicators(
+                    pulse_id, [((i.type, i.indicator), indicator_id)])
+            if self.indicator_cache is not None:
+                self.indicator_cache.put(_type, i.indicator, indicator_id)
+            return indicator_id
+
+        def create(item):
+            i, _type = item
+            result = self.add_crits_indicator(i.indicator, _type,
+                                              self.crits_source)
+            if not result:
+                raise ValueError('CRITs did not add the indicator')
+            return created(i, _type, result)
 
-            # Add the indicators to CRITs
-            mapping = self.get_indicator_mapping()
-            for i in indicator_data:
-                # Reuse the params from creating the event
-                if i['type'] in mapping:
-                    _type = mapping[i['type']]
+        def create_batch(items):
+            outcomes = self.add_crits_indicators(
+                [(i.indicator, _type) for i, _type in items],
+                self.crits_source)
+            if not outcomes:
+                return outcomes
+            return [(created(i, _type, result), None) if result else
+                    (None, error)
+                    for (i, _type), (result, error) in zip(items, outcomes)]
+
+        def add(i):
+            _type, indicator_id = prepare(i)
+            if _type is None or indicator_id:
+                return indicator_id
+            return create((i, _type))
+
+        def add_batch(batch):
+            results = []
+            pending = []
+            for i in batch:
+                _type, indicator_id = prepare(i)
+                if _type is None or indicator_id:
+                    results.append((i, indicator_id, None))
                 else:
-                    # We found an indicator with a type we don't support.
-                    print("We don't support type {}".format(i['type']))
-                    continue
-                if _type == None:
-                    continue
-                result = self.add_crits_indicator(i['indicator'],
-                                                  mapping[i['type']],
-                                                  self.crits_source,
-                                                  params=params)
-                if result:
-                    print('Indicator created: {}'.format(result))
-                    indicator_id = result['id']
-                    print('Indicator created with id: '
-                          '{}'.format(indicator_id))
-                    relationship_map.append( indicator_id )
-
-
-            # Build the relationships between the event and indicators
-            print('Building relationships.')
-            for _id in relationship_map:
-                self.build_crits_relationship(event_id, _id, params=params,
-                                              proxies=self.crits_proxies,
-                                              verify=self.crits_verify)
+                    pending.append((i, _type))
+            for (i, _), indicator_id, error in self.submit_batch(
+                    'indicators', pending, create_batch, create):
+                results.append((i, indicator_id, error))
+            return results
+
+        if self.bulk_size > 1:
+            stage = self.run_stage(add_batch, chunked(indicator_data,
+                                                      self.bulk_size))
+            work = (result for batch, results, error in stage
+                    for result in (results or
+                                   [(i, None, error) for i in batch]))
+        else:
+            work = self.run_stage(add, indicator_data)
+        for i, indicator_id, error in work:
+            if error:
+                failures.append((i.indicator, str(error)))
+            else:
+                indicator_ids[(i.type, i.indicator)] = indicator_id
+        return indicator_ids, failures
+
+
+    def relate_pulse_indicators(self, event_id, relationship_map,
+                                pulse_id=None):
+        '''
+        Relates each indicator id to the event, journaling each relationship
+        for pulse_id. Returns a list of (indicator id, reason) failures.
+        '''
+        failures = []
+        relate = lambda _id: self.build_crits_relationship(event_id, _id)
+        if self.bulk_size > 1:
+            bulk = lambda ids: self.build_crits_relationships(event_id, ids)
+            relate_batch = lambda batch: self.submit_batch(
+                'relationships', batch, bulk, relate)
+            stage = self.run_stage(relate_batch, chunked(relationship_map,
+                                                         self.bulk_size))
+            work = (result for batch, results, error in stage
+                    for result in (results or
+                                   [(_id, None, error) for _id in batch]))
+        else:
+            work = self.run_stage(relate, relationship_map)
+        for _id, success, error in work:
+            if error or not success:
+                failures.append((_id, str(error or 'Relationship failed')))
+            elif self.journal is not None and pulse_id:
+                self.journal.journal_relationship(pulse_id, _id)
+        return failures
+
+
+    def print_summary(self, results):
+        '''
+        Prints a per-pulse summary of an import run
+        '''
+        print('Import summary:')
+        counts = {}
+        for result in results:
+            counts[result.status] = counts.get(result.status, 0) + 1
+            print('  {:<8} {} {} {}'.format(result.status, result.pulse_id,
+                                            result.title.encode("utf-8"),
+                                            result.message))
+            for indicator, reason in result.failures:
+                print('           failed {}: {}'.format(indicator, reason))
+        print('Pulses processed: {}, imported: {}, updated: {}, skipped: {}, '
+              'deferred: {}, failed: {}'.format(
+                  len(results), counts.get(PulseResult.IMPORTED, 0),
+                  counts.get(PulseResult.UPDATED, 0),
+                  counts.get(PulseResult.SKIPPED, 0),
+                  counts.get(PulseResult.DEFERRED, 0),
+                  counts.get(PulseResult.FAILED, 0)))
+        if self.filtered:
+            print('Indicators normalized: {}, duplicates dropped: {}, invalid '
+                  'dropped: {}'.format(self.filtered.get('normalized', 0),
+                                       self.filtered.get('duplicate', 0),
+                                       self.filtered.get('invalid', 0)))
 
 
     def parse_config(self, location):
@@ -190,6 +3275,18 @@ class OTX2CRITs(object):
         return self.parse_config(CONFIG_FILE)
 
 
+    def get_crits_option(self, option, fallback=None,
+                         getter=ConfigParser.get):
+        '''
+        Reads an option from this target's [crits:<name>] section, falling
+        back to [crits]
+        '''
+        for section in self.crits_sections:
+            if self.config.has_option(section, option):
+                return getter(self.config, section, option)
+        return fallback
+
+
     def get_indicator_mapping(self):
         # Indicators with no matching type return None
         mapping = {
@@ -218,22 +3315,118 @@ class OTX2CRITs(object):
         return mapping
 
 
-    def send_otx_get(self, url, proxies=None, verify=True):
-        headers = {
-            'X-OTX-API-KEY' : self.otx_api_key,
-        }
+    def build_session(self, pool_size, proxies=None, verify=True):
+        '''
+        Builds a requests Session that keeps up to pool_size connections per
+        host alive. Proxy and verify settings are applied once here rather
+        than on every call.
+        '''
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if proxies:
+            # Blank proxy entries in the config mean "no proxy"
+            session.proxies.update({k: v for k, v in proxies.items() if v})
+        session.verify = verify
+        return session
+
+
+    def build_rate_control(self, name, sections, pool_size):
+        '''
+        Builds the RateControl for a service from its config section, or the
+        first of several sections that sets each option
+        '''
+        if isinstance(sections, str):
+            sections = (sections,)
 
-        r = requests.get(url, headers=headers, proxies=proxies, verify=verify)
+        def get(option, fallback):
+            for section in sections:
+                if self.config.has_option(section, option):
+                    return self.config.getfloat(section, option)
+            return fallback
+
+        return RateControl(name,
+                           rate_limit=get('rate_limit', 0),
+                           max_concurrency=int(get('max_concurrency',
+                                                   pool_size)),
+                           max_retries=int(get('max_retries', 5)),
+                           backoff=get('backoff', 1.0),
+                           max_backoff=get('max_backoff', 60.0),
+                           timeout=get('timeout', 60),
+                           metrics=self.metrics)
+
+
+    def send_otx_get(self, url, stage='otx_pulse'):
+        headers = {}
+        if self.otx_cache is not None:
+            headers = self.otx_cache.validators(url)
+        try:
+            r = self.otx_control.request(self.otx_session, 'GET', url,
+                                         stage=stage, headers=headers)
+        except requests.exceptions.RequestException as e:
+            print('Error retrieving AlienVault OTX data: {}'.format(e))
+            return False
+        if r.status_code == 304 and headers:
+            body = self.otx_cache.open(url)
+            if body is None:
+                # Evicted since we asked, so fetch it in full
+                return self.send_otx_get(url, stage=stage)
+            with body:
+                return body.read()
         if r.status_code == 200:
-            return r.text
+            if self.otx_cache is not None:
+                self.otx_cache.store(url, r.headers, r.content)
+            # The raw bytes, for the codec to decode without a str copy
+            return r.content
         else:
             print('Error retrieving AlienVault OTX data')
             print('Status code was: {}'.format(r.status_code))
             return False
 
 
-    def get_pulse_generator(self, modified_since=None,
-                              proxies=None, verify=True):
+    def send_otx_get_stream(self, url):
+        '''
+        Like send_otx_get, but copies the response body to a temporary file
+        as it arrives and returns that file, so the body is never held in
+        memory at once
+        '''
+        headers = {}
+        if self.otx_cache is not None:
+            headers = self.otx_cache.validators(url)
+        try:
+            r = self.otx_control.request(self.otx_session, 'GET', url,
+                                         stage='otx_page', stream=True,
+                                         headers=headers)
+        except requests.exceptions.RequestException as e:
+            print('Error retrieving AlienVault OTX data: {}'.format(e))
+            return False
+        with r:
+            if r.status_code == 304 and headers:
+                body = self.otx_cache.open(url)
+                if body is None:
+                    return self.send_otx_get_stream(url)
+                return body
+            if r.status_code != 200:
+                print('Error retrieving AlienVault OTX data')
+                print('Status code was: {}'.format(r.status_code))
+                return False
+            if self.otx_cache is not None:
+                body = self.otx_cache.new_body()
+            else:
+                body = tempfile.TemporaryFile()
+            for chunk in r.iter_content(chunk_size=65536):
+                body.write(chunk)
+            if 'Content-Length' not in r.headers:
+                self.metrics.add_bytes('otx_page', bytes_in=body.tell())
+        if self.otx_cache is not None:
+            return self.otx_cache.commit(url, r.headers, body)
+        body.seek(0)
+        return body
+
+
+    def get_pulse_generator(self, modified_since=None, known=None):
         '''
         This will yield a pulse and all its data while it can obtain more data.
         The OTX API has an issue when not specifying a "limit" on the pulses
@@ -241,7 +3434,121 @@ class OTX2CRITs(object):
         we don't, the API will only ever return 5 pulses total. Derp.
 
         This also takes advantage of returning multiple pages of pulses, so
-        a reasonable amount of data is returned at once.
+        a reasonable amount of data is returned at once. Unless prefetching is
+        disabled, pages are fetched in the background while the previous
+        ones are being imported.
+
+        With two_phase, pulses are listed and fetched one by one instead,
+        see get_changed_pulses.
+        '''
+        # The spool serves every CRITs instance, so what one of them already
+        # has can't decide what is fetched into it
+        if self.two_phase and self.mode != 'fetch':
+            for pulse in self.get_changed_pulses(modified_since, known):
+                yield pulse
+            return
+        pages = self.get_pulse_pages(modified_since=modified_since)
+        if not self.streaming:
+            # Convert each page as soon as it is decoded, so the raw page is
+            # dropped before it waits in the prefetch queue
+            pages = ([Pulse.from_otx(raw) for raw in page.get('results') or []]
+                     for page in pages)
+        if self.prefetch_pages > 0:
+            pages = prefetch(pages, self.prefetch_pages)
+        for page in pages:
+            if self.streaming:
+                for pulse in page.iter_pulses():
+                    yield Pulse.from_otx(pulse)
+            else:
+                for pulse in page:
+                    yield pulse
+
+
+    def get_changed_pulses(self, modified_since=None, known=None):
+        '''
+        Yields pulses in two phases. Only the id, name and modified time of
+        each pulse are listed first, in the largest pages OTX allows. Pulses
+        for which known(pulse_id, modified) is true are yielded as they are
+        listed, without indicators, so they are skipped and still count
+        towards the sync mark. The others are downloaded in full through
+        get_pulse_data, detail_workers at a time, so the bytes read from
+        OTX follow what is new rather than the size of the subscription.
+
+        This relies on OTX honouring the fields parameter. Should a listing
+        come back with the indicators anyway, its pulses are used as they
+        are and never downloaded a second time.
+        '''
+        if known is None:
+            known = self.has_current_pulse
+        missing = []
+        full_listing = []
+
+        def listing():
+            for page in self.get_pulse_pages(modified_since=modified_since,
+                                             fields=('id', 'name',
+                                                     'modified')):
+                for raw in page.get('results') or []:
+                    if 'indicators' in raw:
+                        if not full_listing:
+                            print('OTX ignored the fields parameter, pulses '
+                                  'are listed in full')
+                            full_listing.append(True)
+                        yield Pulse.from_otx(raw)
+                    else:
+                        yield Pulse(raw['id'], raw.get('name') or '',
+                                    modified=raw.get('modified'))
+
+        def fetch(listed):
+            if isinstance(listed.indicators, IndicatorList) or \
+                    known(listed.id, listed.modified):
+                return listed
+            return self.get_pulse_data(listed.id)
+
+        # Pulses of other shards are never downloaded
+        pulses = self.shard_filter(listing())
+        with ThreadPoolExecutor(max_workers=self.detail_workers) as pool:
+            for listed, future in bounded_map(pool, fetch, pulses,
+                                              self.detail_workers * 2):
+                try:
+                    pulse = future.result()
+                except Exception as e:
+                    print('Error retrieving pulse with id {}: {}'.format(
+                        listed.id, e))
+                    pulse = False
+                if pulse:
+                    yield pulse
+                else:
+                    missing.append(listed.id)
+        if missing:
+            # The listing itself was complete, but these pulses weren't read
+            print('{} pulses could not be downloaded'.format(len(missing)))
+            self.walk_complete = False
+
+
+    def has_current_pulse(self, pulse_id, modified):
+        '''
+        Whether a pulse is in the local index and there is nothing to add
+        to it: it isn't half imported, and with update it hasn't changed
+        since it was imported
+        '''
+        if self.index is None or pulse_id not in self.index:
+            return False
+        if self.journal is not None and \
+                self.journal.get_journal(pulse_id) is not None:
+            return False
+        if self.update:
+            return bool(modified) and \
+                self.index.get_modified(pulse_id) == modified
+        return True
+
+
+    def get_pulse_pages(self, modified_since=None, fields=None):
+        '''
+        Yields each decoded page of /pulses/subscribed, following the "next"
+        links until there are no more pages. In streaming mode the pages are
+        StreamedPage objects. With fields, OTX is asked for just those
+        fields of each pulse, as many pulses per page as it allows, and the
+        pages are always decoded in one go.
         '''
         request_args = ''
         args = []
@@ -250,35 +3557,41 @@ class OTX2CRITs(object):
             args.append('modified_since={}'.format(\
                 modified_since.strftime('%Y-%m-%d %H:%M:%S.%f')))
 
-        args.append('limit=10')
+        if fields:
+            args.append('fields={}'.format(','.join(fields)))
+            args.append('limit={}'.format(OTX_MAX_PAGE_SIZE))
+        else:
+            args.append('limit={}'.format(self.page_size))
         args.append('page=1')
         request_args = '&'.join(args)
         request_args = '?{}'.format(request_args)
 
-        response_data = self.send_otx_get('{}/pulses/subscribed{}'\
-                                          .format(self.otx_url, request_args),
-                                            proxies=proxies, verify=verify)
+        if self.streaming and not fields:
+            send = self.send_otx_get_stream
+            decode = StreamedPage
+        else:
+            send = lambda url: self.send_otx_get(url, stage='otx_page')
+            decode = self.codec.loads
+
+        self.walk_complete = False
+        response_data = send('{}/pulses/subscribed{}'\
+                             .format(self.otx_url, request_args))
         # We are going to loop through to get all the pulse data
-        generator_data = []
         while response_data:
-            all_pulses = json.loads(response_data)
-            if 'results' in all_pulses:
-                for pulse in all_pulses['results']:
-                    yield pulse
+            all_pulses = decode(response_data)
+            yield all_pulses
             response_data = None
-            if 'next' in all_pulses:
-                if all_pulses['next']:
-                    response_data = self.send_otx_get(all_pulses['next'],
-                                                      proxies=proxies,
-                                                      verify=verify)
+            if all_pulses.get('next'):
+                response_data = send(all_pulses.get('next'))
+            else:
+                self.walk_complete = True
 
 
-    def get_pulse_data(self, pulse_id, proxies=None, verify=True):
+    def get_pulse_data(self, pulse_id):
         response_data = self.send_otx_get('{}/pulses/{}'.format(self.otx_url,
-                                                                pulse_id),
-                                     proxies=proxies, verify=verify)
+                                                                pulse_id))
         if response_data:
-            return json.loads(response_data)
+            return Pulse.from_otx(self.codec.loads(response_data))
         else:
             print('Error retrieving pulse with id {}'.format(pulse_id))
             return False
@@ -287,29 +3600,94 @@ class OTX2CRITs(object):
     def is_pulse_in_crits(self, pulse_id):
         '''
         Checks to see if the given pulse_id is already in CRITs as a ticket
-        in an Event object
+        in an Event object. The local index is checked first; CRITs is only
+        asked about pulses the index has never seen.
         '''
-        result = self.crits.event_count( params={ 'c-tickets.ticket_number' :
-                                                 pulse_id } )
-        if result > 0:
+        if self.index is not None and pulse_id in self.index:
+            return True
+        result = self.crits_get('events', params={ 'c-tickets.ticket_number' :
+                                                   pulse_id, 'limit' : 1,
+                                                   'only' : 'id' },
+                                stage='crits_lookup')
+        if result and result['meta']['total_count'] > 0:
+            if self.index is not None and result['objects']:
+                self.index.add(pulse_id,
+                               self.get_object_id(result['objects'][0]))
             return True
         return False
 
 
+    def reconcile_index(self, page_size=500):
+        '''
+        Rebuilds the local pulse index from the tickets on our CRITs events
+        in one paginated pass over the events API
+        '''
+        if self.index is None:
+            print('The pulse index is disabled, nothing to reconcile')
+            return False
+        print('Rebuilding the pulse index from CRITs')
+        rows = []
+        offset = 0
+        while True:
+            result = self.crits_get('events', params={
+                'c-source.name' : self.crits_source,
+                'only' : 'id,tickets',
+                'limit' : page_size,
+                'offset' : offset,
+            }, stage='crits_reconcile')
+            if not result:
+                print('Error reading events from CRITs, index left unchanged')
+                return False
+            for event in result['objects']:
+                event_id = self.get_object_id(event)
+                for ticket in event.get('tickets', []):
+                    rows.append((ticket['ticket_number'], event_id,
+                                 ticket.get('date')))
+            offset += len(result['objects'])
+            if not result['objects'] or offset >= result['meta']['total_count']:
+                break
+        self.index.rebuild(rows)
+        print('Pulse index rebuilt with {} pulses'.format(len(rows)))
+        return True
+
+
+    def get_object_id(self, crits_object):
+        '''
+        CRITs API objects carry their id as _id, but accept id as well
+        '''
+        if '_id' in crits_object:
+            return crits_object['_id']
+        return crits_object.get('id')
+
+
     def build_crits_event(self, event_title, crits_source, description='',
                           params={}):
         '''
         Builds an event in CRITs
         '''
-        event = self.crits.add_event('Intel Sharing', event_title, description,
-                                crits_source, params=params)
-        return event
+        data = dict(params)
+        data.update({
+            'event_type' : 'Intel Sharing',
+            'title' : event_title,
+            'description' : description,
+            'source' : crits_source,
+        })
+        # Creating an event twice would duplicate it, so only retry when
+        # CRITs is throttling us
+        event = self.crits_post('events', data, idempotent=False,
+                                stage='crits_event')
+        return event or {}
 
 
     def add_crits_indicator(self, indicator_value, indicator_type, crits_source,
                             params={}):
-        result = self.crits.add_indicator(indicator_type, indicator_value,
-                                          crits_source, params=params)
+        data = dict(params)
+        data.update({
+            'type' : indicator_type,
+            'value' : indicator_value,
+            'source' : crits_source,
+        })
+        result = self.crits_post('indicators', data, stage='crits_indicator')
         if result:
             if result['return_code'] == 0:
                 return result
@@ -319,8 +3697,89 @@ class OTX2CRITs(object):
         return False
 
 
-    def add_ticket_to_crits_event(self, event_id, pulse_id, params={},
-                                  proxies={}, verify=True):
+    def add_crits_indicators(self, indicators, crits_source):
+        '''
+        Adds several (value, type) indicators in one call. Returns an
+        (indicator result, error) pair per indicator, or None or False as
+        crits_bulk does.
+        '''
+        objects = [{
+            'type' : indicator_type,
+            'value' : indicator_value,
+            'source' : crits_source,
+        } for indicator_value, indicator_type in indicators]
+        url = '{}/api/v1/{}/'.format(self.crits_url, 'indicators')
+        results = self.crits_bulk(url, objects, stage='crits_indicator')
+        if not results:
+            return results
+        return [(result, None) if result.get('return_code') == 0 and
+                result.get('id') else
+                (None, ValueError(result.get('message') or
+                                  'CRITs did not add the indicator'))
+                for result in results]
+
+
+    def crits_bulk(self, url, objects, stage):
+        '''
+        Sends several objects or actions to CRITs in one PATCH of
+        {"objects": [...]}, the way tastypie takes bulk changes. Returns the
+        list of per-object results, None if url doesn't take batches, or
+        False if the batch failed.
+        '''
+        r = self.crits_control.request(self.crits_session, 'PATCH', url,
+                                       stage=stage, headers={
+                                           'Content-Type' : 'application/json',
+                                       },
+                                       data=self.codec.dumps({
+                                           'objects' : objects,
+                                       }))
+        if r.status_code in (404, 405, 501):
+            return None
+        if r.status_code not in (200, 202):
+            print('Error with status code {0} and message {1} when sending '
+                  'a batch to CRITs {2}'.format(r.status_code, r.text, url))
+            return False
+        try:
+            results = self.codec.loads(r.content).get('objects')
+        except (ValueError, AttributeError):
+            results = None
+        if not isinstance(results, list) or len(results) != len(objects) or \
+                not all(isinstance(result, dict) for result in results):
+            # Handled as a single object, or not at all
+            return None
+        return results
+
+
+    def crits_get(self, resource, params={}, stage='crits_get'):
+        '''
+        Queries a CRITs API resource list and returns the decoded response
+        '''
+        url = '{}/api/v1/{}/'.format(self.crits_url, resource)
+        r = self.crits_control.request(self.crits_session, 'GET', url,
+                                       stage=stage, params=params)
+        if r.status_code == 200:
+            return self.codec.loads(r.content)
+        print('Error with status code {0} and message {1} when querying '
+              'CRITs {2}'.format(r.status_code, r.text, resource))
+        return False
+
+
+    def crits_post(self, resource, data, idempotent=True, stage='crits_post'):
+        '''
+        Creates a CRITs object through the API and returns the decoded response
+        '''
+        url = '{}/api/v1/{}/'.format(self.crits_url, resource)
+        r = self.crits_control.request(self.crits_session, 'POST', url,
+                                       idempotent=idempotent, stage=stage,
+                                       data=data)
+        if r.status_code == 200:
+            return self.codec.loads(r.content)
+        print('Error with status code {0} and message {1} when adding to '
+              'CRITs {2}'.format(r.status_code, r.text, resource))
+        return False
+
+
+    def add_ticket_to_crits_event(self, event_id, pulse_id):
         '''
         Adds a ticket to the provided CRITs Event
         '''
@@ -340,8 +3799,18 @@ class OTX2CRITs(object):
             }
         }
 
-        r = requests.patch(submit_url, headers=headers, proxies=proxies,
-                           params=params, data=json.dumps(data), verify=False)
+        # A retried ticket_add would add the ticket twice
+        try:
+            r = self.crits_control.request(self.crits_session, 'PATCH',
+                                           submit_url, idempotent=False,
+                                           stage='crits_ticket',
+                                           headers=headers,
+                                           data=self.codec.dumps(data))
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            print('Error when adding a ticket to event: {0} <-> {1}: '
+                  '{2}'.format(event_id, pulse_id, e))
+            return False
         if r.status_code == 200:
             print('Ticket added successfully: {0} <-> {1}'.format(event_id,
                                                                   pulse_id))
@@ -353,8 +3822,7 @@ class OTX2CRITs(object):
         return False
 
 
-    def build_crits_relationship(self, event_id, indicator_id, params={},
-                                 proxies={}, verify=True):
+    def build_crits_relationship(self, event_id, indicator_id):
         '''
         Builds a relationship between the given event and indicator IDs
         '''
@@ -374,12 +3842,25 @@ class OTX2CRITs(object):
             'rel_reason' : 'Related during automatic OTX import'
         }
 
-        r = requests.patch(submit_url, proxies=proxies, params=params,
-                           data=data, verify=False)
+        r = self.crits_control.request(self.crits_session, 'PATCH', submit_url,
+                                       stage='crits_relationship',
+                                       headers=headers,
+                                       data=self.codec.dumps(data))
         if r.status_code == 200:
-            print('Relationship built successfully: {0} <-> '
-                  '{1}'.format(event_id,indicator_id))
-            return True
+            try:
+                result = self.codec.loads(r.content)
+            except ValueError:
+                result = None
+            if not isinstance(result, dict):
+                result = {'return_code' : 0}
+            built, error = self._relationship_result(result)
+            if built:
+                print('Relationship built successfully: {0} <-> '
+                      '{1}'.format(event_id,indicator_id))
+                return True
+            print('Error when building the relationship {0} <-> {1}: '
+                  '{2}'.format(event_id, indicator_id, error))
+            return False
         else:
             print('Error with status code {0} and message {1} between these '
                   'indicators: {2} <-> {3}'.format(r.status_code, r.text,
@@ -387,6 +3868,461 @@ class OTX2CRITs(object):
             return False
 
 
+    @staticmethod
+    def _relationship_result(result):
+        '''
+        The (success, error) pair for a forge_relationship result, the same
+        for single and bulk calls. A relationship that already exists is
+        what was asked for, e.g. when a pulse is imported again.
+        '''
+        message = result.get('message') or ''
+        if result.get('return_code', 0) == 0 or \
+                'already exists' in message.lower():
+            return True, None
+        return False, ValueError(message or 'Relationship failed')
+
+
+    def build_crits_relationships(self, event_id, indicator_ids):
+        '''
+        Builds the relationships between an event and several indicators in
+        one call. Returns a (success, error) pair per indicator, or None or
+        False as crits_bulk does.
+        '''
+        submit_url = '{}/api/v1/{}/{}/'.format(self.crits_url, 'events',
+                                               event_id)
+        now = datetime.datetime.now()
+        objects = [{
+            'action' : 'forge_relationship',
+            'right_type' : 'Indicator',
+            'right_id' : indicator_id,
+            'rel_type' : 'Related To',
+            'rel_date' : now,
+            'rel_confidence' : 'high',
+            'rel_reason' : 'Related during automatic OTX import'
+        } for indicator_id in indicator_ids]
+        results = self.crits_bulk(submit_url, objects,
+                                  stage='crits_relationship')
+        if not results:
+            return results
+        results = [self._relationship_result(result) for result in results]
+        print('Relationships built: {} indicators of {}'.format(
+            sum(1 for built, _ in results if built), event_id))
+        return results
+
+
+class FanOutLane(object):
+    '''
+    One CRITs target's share of a fan-out run: a bounded queue of pulses
+    waiting to be imported, and a temporary spool for the pulses that
+    arrive while the queue is full. Spilling instead of waiting means a
+    slow or stuck target never holds back the OTX walk or the other targets.
+    '''
+    DONE = object()
+
+    def __init__(self, otx2crits, queue_size, spill_dir):
+        self.otx2crits = otx2crits
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.spill_dir = spill_dir
+        self.spill = None
+        self.spilled = 0
+        # Set once the target has stopped taking pulses
+        self.finished = threading.Event()
+
+
+    def put(self, pulse):
+        if self.finished.is_set():
+            return
+        try:
+            self.queue.put_nowait(pulse)
+        except queue.Full:
+            if self.spill is None:
+                self.spill = SpoolWriter(self.spill_dir, 1 << 30,
+                                         codec=self.otx2crits.codec)
+            self.spill.write(pulse)
+            self.spilled += 1
+
+
+    def close(self):
+        '''
+        Tells the target that no more pulses are coming
+        '''
+        if self.spill is not None:
+            self.spill.close()
+        while not self.finished.is_set():
+            try:
+                self.queue.put(self.DONE, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+
+    def pulses(self):
+        '''
+        Yields the queued pulses, then the spilled ones
+        '''
+        while True:
+            pulse = self.queue.get()
+            if pulse is self.DONE:
+                break
+            yield pulse
+        if self.spilled:
+            print('Importing {} pulses that were spilled while CRITs {} was '
+                  'behind'.format(self.spilled, self.otx2crits.crits_target))
+            reader = SpoolReader(self.spill_dir,
+                                 streaming=self.otx2crits.streaming,
+                                 codec=self.otx2crits.codec)
+            for pulse, _ in reader.read():
+                yield pulse
+
+
+class FanOut(object):
+    '''
+    Imports into several CRITs targets at once while reading each pulse
+    from OTX only once. Every target is a full OTX2CRITs instance with its
+    own state database, caches, sessions and rate control, so dedup,
+    retries and failures stay separate per target. A thread walks OTX with
+    the first target's instance and hands each pulse to every target's
+    FanOutLane. Each target imports from its lane in its own thread.
+    '''
+
+    def __init__(self, targets):
+        self.targets = targets
+        self.source = targets[0]
+        self.config = self.source.config
+        self.state_dir = self.source.state_dir
+        self.crits_target = '+'.join(t.crits_target for t in targets)
+        self.queue_size = self.config.getint('crits', 'fanout_queue_size',
+                                             fallback=100)
+        self.results = {}
+
+
+    @property
+    def walk_complete(self):
+        return all(t.walk_complete for t in self.targets)
+
+
+    def run_targets(self, func):
+        '''
+        Calls func(target) for every target in its own thread. Returns the
+        PulseResults of all targets; a target that raises gets none.
+        '''
+        self.results = {}
+
+        def run(target):
+            try:
+                self.results[target.crits_target] = func(target)
+            except Exception as e:
+                print('Error importing into CRITs {}: {}'.format(
+                    target.crits_target, e))
+                self.results[target.crits_target] = []
+                target.walk_complete = False
+
+        threads = [threading.Thread(target=run, args=(t,),
+                                    name='crits-{}'.format(t.crits_target))
+                   for t in self.targets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return [r for t in self.targets for r in self.results[t.crits_target]]
+
+
+    def execute(self, workers=1, indicator_workers=1):
+        '''
+        Walks OTX once and imports every pulse into every target
+        '''
+        # Walk back as far as the target that is furthest behind needs
+        marks = [t.modified_since for t in self.targets]
+        since = None if None in marks else min(marks)
+        spill_root = tempfile.mkdtemp(prefix='fanout-', dir=self.state_dir)
+        lanes = [FanOutLane(t, self.queue_size,
+                            os.path.join(spill_root, t.crits_target))
+                 for t in self.targets]
+
+        def produce():
+            try:
+                # A pulse is only downloaded in full if some target needs it
+                known = lambda pulse_id, modified: all(
+                    t.has_current_pulse(pulse_id, modified)
+                    for t in self.targets)
+                pulses = self.source.get_pulse_generator(modified_since=since,
+                                                         known=known)
+                pulses = self.source.time_iterator(
+                    self.source.shard_filter(pulses), 'otx_wait')
+                for pulse in self.source.until_stopped(pulses):
+                    for lane in lanes:
+                        lane.put(pulse)
+            except Exception as e:
+                print('Error reading pulses from OTX: {}'.format(e))
+                self.source.walk_complete = False
+            finally:
+                for lane in lanes:
+                    lane.close()
+
+        def consume(target):
+            lane = lanes[self.targets.index(target)]
+            try:
+                results = target.execute(workers=workers,
+                                         indicator_workers=indicator_workers,
+                                         pulses=lane.pulses())
+            finally:
+                lane.finished.set()
+            producer.join()
+            target.walk_complete = self.source.walk_complete and \
+                not target.stopping.is_set()
+            if target.checkpoint is not None:
+                target.checkpoint.finish(target.walk_complete, since)
+            return results
+
+        producer = threading.Thread(target=produce, name='otx-fanout')
+        producer.daemon = True
+        producer.start()
+        try:
+            return self.run_targets(consume)
+        finally:
+            shutil.rmtree(spill_root, ignore_errors=True)
+
+
+    def fetch_to_spool(self):
+        return self.source.fetch_to_spool()
+
+
+    def import_spool(self, workers=1, indicator_workers=1, position=None):
+        return self.run_targets(lambda target: target.import_spool(
+            workers=workers, indicator_workers=indicator_workers,
+            position=position))
+
+
+    def reconcile_index(self):
+        return all([t.reconcile_index() for t in self.targets])
+
+
+    def write_metrics(self, results, json_path=None, prom_path=None):
+        '''
+        Writes each target's metrics to its own file, named after the
+        target. Returns the summaries by target.
+        '''
+        summaries = {}
+        for target in self.targets:
+            name = target.crits_target
+            summaries[name] = target.write_metrics(
+                self.results.get(name, []),
+                json_path=target_path(json_path, name),
+                prom_path=target_path(prom_path, name))
+        return summaries
+
+
+    def new_cycle(self):
+        for target in self.targets:
+            target.new_cycle()
+
+
+    def stop(self):
+        for target in self.targets:
+            target.stop()
+
+
+    def close(self):
+        for target in self.targets:
+            target.close()
+
+
+def target_path(path, target):
+    '''
+    Adds a target name to a file name, before its extension
+    '''
+    if not path:
+        return path
+    root, ext = os.path.splitext(path)
+    return '{}-{}{}'.format(root, target, ext)
+
+
+def build_otx2crits(args, days=None, full=False):
+    '''
+    Builds the OTX2CRITs instance for the CRITs targets given with
+    --targets or in [crits] targets, or a FanOut over them when there are
+    several. --dev alone always means just the dev target.
+    '''
+    kwargs = {
+        'config' : args.config,
+        'days' : days,
+        'full' : full,
+        'mode' : args.mode,
+        'update' : args.update,
+        'shard' : args.shard,
+    }
+    names = [n.strip() for n in (args.targets or '').split(',') if n.strip()]
+    first = OTX2CRITs(dev=args.dev, target=names[0] if names else None,
+                      **kwargs)
+    if not names and not args.dev:
+        names = [n.strip() for n in first.config.get(
+            'crits', 'targets', fallback='').split(',') if n.strip()]
+        if names and names[0] != first.crits_target:
+            first.close()
+            first = OTX2CRITs(target=names[0], **kwargs)
+    if len(names) <= 1:
+        return first
+    print('Importing into CRITs targets {}'.format(', '.join(names)))
+    return FanOut([first] + [OTX2CRITs(target=name, **kwargs)
+                             for name in names[1:]])
+
+
+def parse_shard(value):
+    '''
+    Parses an "I/N" shard argument into (I, N)
+    '''
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected I/N, e.g. 0/4')
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError('I must be between 0 and N-1')
+    return index, count
+
+
+def run_once(otx2crits, args, position=None):
+    '''
+    Runs one fetch, import or sync according to args and writes the
+    metrics files asked for. Returns the PulseResults and the run summary.
+    '''
+    if args.mode == 'fetch':
+        otx2crits.fetch_to_spool()
+        results = []
+    elif args.mode == 'import':
+        results = otx2crits.import_spool(
+            workers=args.workers, indicator_workers=args.indicator_workers,
+            position=position)
+    else:
+        results = otx2crits.execute(workers=args.workers,
+                                    indicator_workers=args.indicator_workers)
+    summary = otx2crits.write_metrics(results, json_path=args.metrics_json,
+                                      prom_path=args.prom_textfile)
+    return results, summary
+
+
+class Daemon(object):
+    '''
+    Keeps one OTX2CRITs instance alive and runs it every interval seconds,
+    plus up to jitter seconds at random so several daemons don't poll OTX
+    in step. Sessions, connection pools and caches stay warm between
+    cycles. SIGHUP reloads the config before the next cycle, and SIGTERM or
+    SIGINT stops once the pulses in flight are done. The state of the
+    daemon and the summary of its last cycle are kept in a JSON status file.
+    '''
+
+    def __init__(self, args, position=None):
+        self.args = args
+        self.position = position
+        self.stopping = threading.Event()
+        self.reload_requested = False
+        self.cycles = 0
+        self.last_summary = None
+        self.last_error = None
+        self.otx2crits = self.build(days=args.days, full=args.full)
+
+
+    def build(self, days=None, full=False):
+        otx2crits = build_otx2crits(self.args, days=days, full=full)
+        config = otx2crits.config
+        self.interval = config.getfloat('daemon', 'interval', fallback=900)
+        self.jitter = config.getfloat('daemon', 'jitter', fallback=60)
+        self.status_file = os.path.expanduser(config.get(
+            'daemon', 'status_file', fallback=os.path.join(
+                otx2crits.state_dir,
+                'status-{}.json'.format(otx2crits.crits_target))))
+        return otx2crits
+
+
+    def handle_stop(self, signum, frame):
+        print('Received signal {}, shutting down'.format(signum))
+        self.stopping.set()
+        self.otx2crits.stop()
+
+
+    def handle_reload(self, signum, frame):
+        print('Received SIGHUP, the config will be reloaded before the next '
+              'cycle')
+        self.reload_requested = True
+
+
+    def reload(self):
+        '''
+        Swaps in an instance built from the reloaded config. If the new
+        config is broken the old instance carries on.
+        '''
+        self.reload_requested = False
+        try:
+            otx2crits = self.build()
+        except Exception as e:
+            print('Error reloading the config, keeping the old one: '
+                  '{}'.format(e))
+            self.last_error = 'Config reload failed: {}'.format(e)
+            self.otx2crits.new_cycle()
+            return
+        self.otx2crits.close()
+        self.otx2crits = otx2crits
+        print('Config reloaded')
+
+
+    def write_status(self, state, next_run=None):
+        status = {
+            'pid' : os.getpid(),
+            'state' : state,
+            'mode' : self.args.mode,
+            'crits_target' : self.otx2crits.crits_target,
+            'cycles' : self.cycles,
+            'updated' : datetime.datetime.now().isoformat(),
+            'next_run' : next_run.isoformat() if next_run else None,
+            'last_error' : self.last_error,
+            'last_cycle' : self.last_summary,
+        }
+        try:
+            write_atomically(self.status_file,
+                             json.dumps(status, indent=2, sort_keys=True) +
+                             '\n')
+        except (IOError, OSError) as e:
+            print('Error writing the status file: {}'.format(e))
+
+
+    def run_cycle(self):
+        self.write_status('running')
+        self.cycles += 1
+        try:
+            results, self.last_summary = run_once(self.otx2crits, self.args,
+                                                  position=self.position)
+            self.last_error = None
+        except Exception as e:
+            # One bad cycle, such as OTX being down, must not kill the daemon
+            print('Error in cycle {}: {}'.format(self.cycles, e))
+            self.last_error = str(e)
+        # A replay position only applies to the first cycle
+        self.position = None
+
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        print('Running as a daemon every {}s (+ up to {}s of jitter), status '
+              'in {}'.format(self.interval, self.jitter, self.status_file))
+        while True:
+            self.run_cycle()
+            if self.stopping.is_set():
+                break
+            delay = self.interval + random.uniform(0, self.jitter)
+            next_run = datetime.datetime.now() + \
+                datetime.timedelta(seconds=delay)
+            self.write_status('sleeping', next_run=next_run)
+            if self.stopping.wait(delay):
+                break
+            if self.reload_requested:
+                self.reload()
+            else:
+                self.otx2crits.new_cycle()
+        self.write_status('stopped')
+        self.otx2crits.close()
+
+
 def main():
     argparser = argparse.ArgumentParser()
     argparser.add_argument('--dev', dest='dev', action='store_true',
@@ -397,11 +4333,80 @@ def main():
     argparser.add_argument('-d', dest='days', default=None, type=int,
                            help='Specify the maximum age of a pulse in the '
                            'number of days.')
+    argparser.add_argument('--full', dest='full', action='store_true',
+                           default=False, help='Ignore the saved sync mark '
+                           'and look at every subscribed pulse.')
+    argparser.add_argument('--workers', dest='workers', default=1, type=int,
+                           help='Number of pulses to import in parallel. '
+                           'Defaults to 1.')
+    argparser.add_argument('--indicator-workers', dest='indicator_workers',
+                           default=1, type=int, help='Number of indicators '
+                           'and relationships to add in parallel. Defaults '
+                           'to 1.')
+    argparser.add_argument('--metrics-json', dest='metrics_json',
+                           default=None, help='Write a JSON summary of the '
+                           'run, with per-stage timings, to this file.')
+    argparser.add_argument('--prom-textfile', dest='prom_textfile',
+                           default=None, help='Write run metrics to this file '
+                           'for the Prometheus node_exporter textfile '
+                           'collector. Use a name ending in .prom.')
+    argparser.add_argument('--reconcile', dest='reconcile',
+                           action='store_true', default=False,
+                           help='Rebuild the local pulse index from CRITs '
+                           'before importing.')
+    argparser.add_argument('--mode', dest='mode', default='sync',
+                           choices=OTX2CRITs.MODES, help='sync imports '
+                           'straight from OTX (the default), fetch only '
+                           'spools pulses from OTX to disk and import only '
+                           'imports spooled pulses into CRITs.')
+    argparser.add_argument('--spool-from', dest='spool_from', default=None,
+                           metavar='SEGMENT[:OFFSET]', help='In import mode, '
+                           'start at this spool segment and byte offset '
+                           'instead of where the last import stopped.')
+    argparser.add_argument('--update', dest='update', action='store_true',
+                           default=False, help='Add the new indicators of '
+                           'pulses that changed since they were imported, '
+                           'instead of skipping them.')
+    argparser.add_argument('--targets', dest='targets', default=None,
+                           help='Comma separated CRITs targets to import '
+                           'into, e.g. prod,dev,regional. Each pulse is read '
+                           'from OTX once and imported into all of them. '
+                           'Defaults to [crits] targets, or prod.')
+    argparser.add_argument('--shard', dest='shard', default=None,
+                           type=parse_shard, metavar='I/N', help='Only '
+                           'handle the pulses in shard I (counting from 0) '
+                           'of N, claiming each one in the shared lease '
+                           'database first. Run N workers with I = 0 to N-1 '
+                           'to split an import between them.')
+    argparser.add_argument('--daemon', dest='daemon', action='store_true',
+                           default=False, help='Keep running and poll OTX '
+                           'every [daemon] interval seconds instead of '
+                           'running once.')
     args = argparser.parse_args()
 
+    position = None
+    if args.spool_from:
+        segment, _, offset = args.spool_from.partition(':')
+        position = (os.path.basename(segment), int(offset or 0))
+
+    if args.daemon:
+        daemon = Daemon(args, position=position)
+        if args.reconcile:
+            if not daemon.otx2crits.reconcile_index():
+                sys.exit(1)
+        daemon.run()
+        return
 
-    otx2crits = OTX2CRITs(dev=args.dev, config=args.config, days=args.days)
-    otx2crits.execute()
+    otx2crits = build_otx2crits(args, days=args.days, full=args.full)
+    if args.reconcile:
+        if not otx2crits.reconcile_index():
+            sys.exit(1)
+    results, _ = run_once(otx2crits, args, position=position)
+    if not otx2crits.walk_complete:
+        print('Not every page of pulses could be read from OTX')
+        sys.exit(1)
+    if any(r.status == PulseResult.FAILED for r in results):
+        sys.exit(1)
 
 
 if __name__ == '__main__':